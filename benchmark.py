@@ -0,0 +1,78 @@
+"""Benchmarks of the bot's database lookups.
+
+Fills a scratch database with members and contestants, then times looking every one of them up with the
+single-key accessors, one request per key, against the bulk accessors. Never touches the bot's own database."""
+import argparse
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+LOOKUPS = ["uid2vid", "vid2uid", "get_contestant", "get_voter"]
+
+
+def seed(thread, members: int):
+    from package.common.sqlutils import run
+
+    run(thread, """WITH RECURSIVE Numbers (value) AS (SELECT 0 UNION ALL SELECT value + 1 FROM Numbers WHERE value < {:d})
+        INSERT INTO Members (uid, vid) SELECT value, value + 1000000 FROM Numbers;""".format(members - 1))
+    run(thread, "INSERT INTO Contestants (uid, alive) SELECT uid, 1 FROM Members;")
+
+
+def timed(func, *args, **kwargs) -> float:
+    start = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - start
+
+
+def bench(thread, members: int):
+    from package.common import sqlutils
+
+    uids = list(range(members))
+    vids = [uid + 1000000 for uid in uids]
+    single = {
+        "uid2vid": lambda: [sqlutils.uid2vid(thread, uid) for uid in uids],
+        "vid2uid": lambda: [sqlutils.vid2uid(thread, vid) for vid in vids],
+        "get_contestant": lambda: [list(sqlutils.get_contestant(thread, uid)) for uid in uids],
+        "get_voter": lambda: [list(sqlutils.get_voter(thread, uid=uid)) for uid in uids]
+    }
+    bulk = {
+        "uid2vid": lambda: sqlutils.uid2vid_many(thread, uids),
+        "vid2uid": lambda: sqlutils.vid2uid_many(thread, vids),
+        "get_contestant": lambda: sqlutils.get_contestants(thread, uids),
+        "get_voter": lambda: sqlutils.get_voters(thread, uids=uids)
+    }
+    print("== {:d} members".format(members))
+    print("{:<16}{:>12}{:>12}{:>10}".format("lookup", "single ms", "bulk ms", "speedup"))
+    for name in LOOKUPS:
+        one = timed(single[name])
+        many = timed(bulk[name])
+        print("{:<16}{:>12.1f}{:>12.1f}{:>9.1f}x".format(name, one * 1000, many * 1000, one / many))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("members", nargs="*", type=int, default=[1000, 10000], help="Numbers of members to try.")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from package.common.sqlhandle import SQLThread
+    from package.common.sqlutils import construct_schema, run
+
+    scratch = tempfile.mkdtemp(prefix="mtwow-benchmark-")
+    print("Running in {}".format(scratch))
+    thread = SQLThread(os.path.join(scratch, "mtwow.sqlite"))
+    thread.start()
+    try:
+        construct_schema(thread)
+        for members in args.members:
+            run(thread, "DELETE FROM Members;")
+            run(thread, "DELETE FROM Contestants;")
+            seed(thread, members)
+            bench(thread, members)
+    finally:
+        thread.close(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Offline load test of the bot.
+
+Builds the bot from main.py against a stand-in for the Discord gateway and HTTP API, replays a scripted or
+recorded stream of messages at a fixed rate, and reports command latency, event loop lag and SQL queue depth.
+Runs in a scratch directory with its own database and never touches the network.
+
+Recorded streams are JSON Lines files of {"at": seconds from start, "user": user number, "content": message}.
+User 0 is the owner."""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+from collections import defaultdict
+from itertools import count
+from time import perf_counter
+from typing import List, Tuple, Dict
+
+OWNER_ID = 100000000000000000
+BOT_ID = 200000000000000000
+SCENARIOS = ["status", "screens", "votes", "search", "round"]
+
+_snowflakes = count(300000000000000000)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def user_payload(uid: int) -> dict:
+    return {"id": str(uid), "username": "user{:d}".format(uid % 100000), "discriminator": "0001", "avatar": None}
+
+
+class FakeHTTP:
+    """Answers the bot's HTTP API requests locally, recording every message it sends."""
+    def __init__(self, bot):
+        self.bot = bot
+        self.sent: Dict[int, List[str]] = defaultdict(list)
+        self.requests = 0
+
+    async def request(self, route, *, files=None, header_bypass_delay=None, **kwargs):
+        self.requests += 1
+        if route.method == "POST" and route.path == "/channels/{channel_id}/messages":
+            payload = kwargs.get("json") or {k: v for k, v in (kwargs.get("form") or [])}
+            content = payload.get("content") or ""
+            self.sent[int(route.channel_id)].append(content)
+            return message_payload(int(route.channel_id), BOT_ID, content)
+        if route.method == "GET" and route.path == "/oauth2/applications/@me":
+            return {"id": str(BOT_ID), "name": "loadtest", "description": "", "icon": None, "rpc_origins": None,
+                    "bot_public": False, "bot_require_code_grant": False, "owner": user_payload(OWNER_ID)}
+        return None
+
+
+def message_payload(channel_id: int, author: int, content: str) -> dict:
+    return {"id": str(next(_snowflakes)), "channel_id": str(channel_id), "author": user_payload(author),
+            "content": content, "attachments": [], "embeds": [], "edited_timestamp": None, "type": 0,
+            "pinned": False, "mention_everyone": False, "tts": False, "mentions": [], "mention_roles": []}
+
+
+class Harness:
+    """Drives the bot from main.py with fake users talking to it in direct messages."""
+    def __init__(self, main, users: int):
+        import discord
+
+        self.main = main
+        self.bot = main.bot
+        self.http = FakeHTTP(self.bot)
+        self.bot.http.request = self.http.request
+        state = self.bot._connection
+        state.user = discord.ClientUser(state=state, data=user_payload(BOT_ID))
+        self.bot.owner_id = OWNER_ID
+        self.users = [OWNER_ID] + [OWNER_ID + i for i in range(1, users + 1)]
+        self.channels = dict()
+        for uid in self.users:
+            self.channels[uid] = state.add_dm_channel({"id": str(uid + 1), "recipients": [user_payload(uid)]})
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors = 0
+        self.lags: List[float] = []
+        self.depths: List[int] = []
+        self.bot.add_listener(self.on_command_error, "on_command_error")
+
+    def reset(self):
+        """Forgets the measurements taken so far."""
+        self.latencies.clear()
+        self.lags.clear()
+        self.depths.clear()
+        self.errors = 0
+
+    async def on_command_error(self, ctx, error):
+        self.errors += 1
+
+    async def send(self, uid: int, content: str):
+        """Delivers a message from a user and waits until the bot has handled it."""
+        import discord
+
+        channel = self.channels[uid]
+        message = discord.Message(state=self.bot._connection, channel=channel,
+                                  data=message_payload(channel.id, uid, content))
+        start = perf_counter()
+        await self.main.on_message(message)
+        self.latencies[content.split(" ", 1)[0]].append(perf_counter() - start)
+
+    async def monitor(self, interval: float = 0.01):
+        """Samples event loop lag and SQL queue depth until cancelled."""
+        while True:
+            start = perf_counter()
+            await asyncio.sleep(interval)
+            self.lags.append(perf_counter() - start - interval)
+            self.depths.append(self.main.sqlthread.queue_depth())
+
+    async def replay(self, stream: List[Tuple[float, int, str]], rate: float = None):
+        """Sends each message of the stream at its time, or at rate messages per second if given."""
+        monitor = asyncio.ensure_future(self.monitor())
+        start = perf_counter()
+        tasks = []
+        for i, (at, uid, content) in enumerate(stream):
+            delay = start + (i / rate if rate else at) - perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.send(uid, content)))
+        await asyncio.gather(*tasks)
+        elapsed = perf_counter() - start
+        monitor.cancel()
+        return elapsed
+
+    def gseeds(self) -> Dict[int, List[str]]:
+        """The screens each user has been sent, by user."""
+        found = dict()
+        for uid in self.users:
+            found[uid] = re.findall(r"\*\*Screen (\w+)\*\*", "\n".join(self.http.sent[self.channels[uid].id]))
+        return found
+
+    def report(self, elapsed: float, messages: int):
+        print("Handled {:d} messages in {:.2f}s ({:.1f}/s), {:d} HTTP requests, {:d} command errors".format(
+            messages, elapsed, messages / elapsed if elapsed else 0, self.http.requests, self.errors))
+        print("{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}".format("command", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+        for command, values in sorted(self.latencies.items()):
+            print("{:<16}{:>8d}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+                command, len(values), percentile(values, 50) * 1000, percentile(values, 95) * 1000,
+                percentile(values, 99) * 1000, max(values) * 1000))
+        print("Event loop lag: p50 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms".format(
+            percentile(self.lags, 50) * 1000, percentile(self.lags, 99) * 1000, max(self.lags or [0]) * 1000))
+        print("SQL queue depth: mean {:.1f}, max {:d}".format(
+            sum(self.depths) / len(self.depths) if self.depths else 0, max(self.depths or [0])))
+
+
+def seed_round(main, users: List[int], responses: int):
+    """Registers every user as a voter and fills the round with responses."""
+    from package.common.sqlutils import run, add_response
+
+    for vid, uid in enumerate(users):
+        run(main.sqlthread, "INSERT OR IGNORE INTO Members (uid, vid) VALUES (?, ?);", (str(uid), str(vid)))
+        run(main.sqlthread, "INSERT OR IGNORE INTO Contestants (uid, alive) VALUES (?, 1);", (str(uid),))
+    for i in range(responses):
+        add_response(main.sqlthread, users[i % len(users)], 1, "response number {:d} about thing {:d}".format(
+            i, i % 17))
+
+
+def scripted(scenario: str, harness: Harness, messages: int) -> List[Tuple[float, int, str]]:
+    prefix = harness.main.data["prefix"]
+    users = harness.users[1:]
+    if scenario == "status":
+        return [(0, users[i % len(users)], prefix + "status") for i in range(messages)]
+    if scenario == "screens":
+        return [(0, users[i % len(users)], prefix + "screen") for i in range(messages)]
+    if scenario == "search":
+        return [(0, users[i % len(users)], prefix + "search thing {:d}".format(i % 17)) for i in range(messages)]
+    if scenario == "votes":
+        stream = []
+        for uid, gseeds in harness.gseeds().items():
+            stream.extend((0, uid, prefix + "vote {} ABCDEFGHIJ".format(gseed)) for gseed in gseeds)
+        return stream[:messages]
+    raise ValueError(scenario)
+
+
+def recorded(filename: str) -> List[Tuple[float, int, str]]:
+    stream = []
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                stream.append((float(entry["at"]), OWNER_ID + int(entry["user"]), entry["content"]))
+    return sorted(stream)
+
+
+async def run(args, main):
+    harness = Harness(main, args.users)
+    await main.on_ready()
+    seed_round(main, harness.users, args.responses)
+    if args.replay:
+        stream = recorded(args.replay)
+        harness.report(await harness.replay(stream, args.rate), len(stream))
+        return
+    scenarios = ["status", "screens", "votes"] if args.scenario == "round" else [args.scenario]
+    if "screens" in scenarios or "votes" in scenarios:
+        await harness.send(OWNER_ID, main.data["prefix"] + "phase voting")
+    if scenarios == ["votes"]:
+        # voters need screens to vote on
+        await harness.replay(scripted("screens", harness, args.messages), None)
+    for scenario in scenarios:
+        print("== " + scenario)
+        stream = scripted(scenario, harness, args.messages)
+        harness.reset()
+        harness.report(await harness.replay(stream, args.rate), len(stream))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", nargs="?", choices=SCENARIOS, default="round")
+    parser.add_argument("-u", "--users", type=int, default=200, help="Number of simulated users.")
+    parser.add_argument("-n", "--messages", type=int, default=1000, help="Messages per scenario.")
+    parser.add_argument("-r", "--rate", type=float, default=200, help="Messages per second. 0 sends them all at once.")
+    parser.add_argument("--responses", type=int, default=300, help="Number of responses in the round.")
+    parser.add_argument("--replay", help="Replay a recorded JSON Lines stream instead, at its own pace "
+                                         "unless a rate is given.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Keep the bot's logging.")
+    args = parser.parse_args()
+    if args.replay:
+        args.replay = os.path.abspath(args.replay)
+        if "--rate" not in sys.argv and "-r" not in sys.argv:
+            args.rate = None
+    if args.rate == 0:
+        args.rate = float("inf")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    scratch = tempfile.mkdtemp(prefix="mtwow-loadtest-")
+    os.chdir(scratch)
+    with open("secrets.json", "w") as f:
+        json.dump({"token": "offline", "db": os.path.join(scratch, "mtwow.sqlite"), "owner": OWNER_ID,
+                   "prefix": "p?", "primaryServer": 0, "portNum": 8080}, f)
+    import main as bot_main
+    bot_main.startup()
+    if not args.verbose:
+        for name in ["discord", "sqlite3", "sqlitethread"]:
+            logging.getLogger(name).setLevel(logging.WARNING)
+    print("Running in {}".format(scratch))
+    try:
+        bot_main.bot.loop.run_until_complete(run(args, bot_main))
+    finally:
+        bot_main.votebuffer.close()
+        bot_main.sqlthread.close(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,10 @@ logging.setLoggerClass(ColoredTerminalLogger)
 import discord
 from discord.ext import commands
 
-from package.common.utils import data, sqlthread, InvalidTimeStringError
+from package.common.utils import data, sqlthread, screencache, votebuffer, InvalidTimeStringError
+from package.common.sqlhandle import SQLThreadOverloadedError, SQLRequestTimeoutError
+from package.common.queries import validate_queries
+from package.common.screens import restore_screens
 from package.common.sqlutils import construct_schema
 
 desc = """A generic miniTWOW Discord bot and website.
@@ -29,10 +32,22 @@ sql_logger.addHandler(handler)
 sql_thread_logger.addHandler(handler)
 
 bot = commands.Bot(command_prefix=data["prefix"], description=desc)
-extensions = ["discord.admin", "discord.sqlutils"]
+extensions = ["discord.admin", "discord.sqlutils", "discord.voting", "discord.responses"]
+
+
+def startup():
+    """Starts the SQL thread, constructs and checks the schema, restores the voting screens of a round in progress,
+    and starts taking votes.
+    Only done when run as a script, since spawned worker processes import this module as __main__."""
+    sqlthread.start()
+    construct_schema(sqlthread)
+    sql_thread_logger.debug("Constructed schema")
+    validate_queries(sqlthread)
+    restored = restore_screens(sqlthread, screencache)
+    if restored:
+        sql_thread_logger.debug("Restored {:d} voting screens".format(restored))
+    votebuffer.start()
 
-construct_schema(sqlthread)
-sql_thread_logger.debug("Constructed schema")
 
 @bot.event
 async def on_ready():
@@ -74,6 +89,9 @@ async def on_command_error(ctx: commands.Context, error: commands.CommandError):
     elif isinstance(error, sqlite3.DatabaseError):
         sql_logger.error(str(error))
         await ctx.send("There was a SQL error while processing.", delete_after=5)
+    elif isinstance(error, (SQLThreadOverloadedError, SQLRequestTimeoutError)):
+        sql_thread_logger.warning(str(error))
+        await ctx.send("The bot is overloaded right now. Please try again later.", delete_after=5)
     elif isinstance(error, InvalidTimeStringError):
         await ctx.send("Invalid time argument provided.", delete_after=5)
 
@@ -82,6 +100,8 @@ async def on_command_error(ctx: commands.Context, error: commands.CommandError):
 async def kill(ctx: commands.Context):
     discord_logger.info("Received shutdown command from {:s}".format(str(ctx.message.author)))
     await bot.close()
+    votebuffer.close()
+    sqlthread.close(timeout=data["sqlTimeout"])
     sys.exit(0)
 
 
@@ -128,4 +148,6 @@ async def reload_all(ctx: commands.Context):
         "Reloaded {:d} of {:d} extensions. Check debug logs for more details.".format(count, len(extensions)))
 
 
-bot.run(data["token"])
\ No newline at end of file
+if __name__ == "__main__":
+    startup()
+    bot.run(data["token"])
\ No newline at end of file
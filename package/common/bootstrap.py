@@ -0,0 +1,134 @@
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from math import ceil
+from string import ascii_uppercase
+from threading import get_ident
+from typing import List, Tuple
+
+import numpy as np
+
+from .screens import deal_screen
+from .sqlhandle import SQLThread
+from .sqlutils import get_round_responses_columns, get_votes_columns
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+RESAMPLES = 10000
+"""Default number of bootstrap resamples."""
+CHUNK = 250
+"""Number of resamples computed by a worker process at a time, which bounds its memory use."""
+
+Interval = namedtuple("Interval", ["id", "uid", "score", "score_low", "score_high", "rank", "rank_low", "rank_high",
+                                   "survival"])
+"""A response's score and rank with their confidence intervals, and the probability its contestant survives."""
+
+
+def vote_scores(gseed: str, vote: str, count: int) -> List[Tuple[int, float]]:
+    """Scores a vote on a screen dealt from count responses, as pairs of response index and score.
+
+    A vote ranks letters of its screen, best first. The best response scores 1, the worst 0, and letters left
+    out of the vote share the positions after the ranked ones."""
+    picks = deal_screen(gseed, count)
+    if len(picks) < 2 or not vote:
+        return []
+    letters = ascii_uppercase[:len(picks)]
+    order = [letters.index(c) for c in vote if c in letters]
+    unranked = [i for i in range(len(picks)) if i not in order]
+    positions = dict((pick, pos) for pos, pick in enumerate(order))
+    # unranked letters tie for the average of the positions left
+    tie = len(order) + (len(unranked) - 1) / 2
+    positions.update((pick, tie) for pick in unranked)
+    return [(picks[pick], 1 - pos / (len(picks) - 1)) for pick, pos in positions.items()]
+
+
+def vote_matrix(ids, votes) -> Tuple[np.ndarray, np.ndarray]:
+    """Builds the votes x responses matrices of scores and of whether the response was on the voter's screen.
+    ids must be in the order screens were dealt from, which is the order of get_round_responses_columns."""
+    scores = np.zeros((len(votes.id), len(ids)))
+    shown = np.zeros((len(votes.id), len(ids)), dtype=bool)
+    for v, (gseed, vote) in enumerate(zip(votes.seed, votes.vote)):
+        for r, score in vote_scores(gseed, vote, len(ids)):
+            scores[v, r] = score
+            shown[v, r] = True
+    return scores, shown
+
+
+_scores = None
+_shown = None
+
+
+def _init_worker(scores: np.ndarray, shown: np.ndarray):
+    """Hands the vote matrices to a worker process once, instead of with every chunk."""
+    global _scores, _shown
+    _scores = scores
+    _shown = shown
+
+
+def _resample(count: int, seed) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the response scores and ranks of count resamples of the votes. Runs in a worker process."""
+    scores, shown = _scores, _shown
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(scores.shape[0], np.full(scores.shape[0], 1 / scores.shape[0]), size=count)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sample = (weights @ scores) / (weights @ shown)
+    # a response no resampled vote saw gets the lowest score
+    sample = np.nan_to_num(sample, nan=-1.0)
+    ranks = np.empty(sample.shape, dtype=np.int32)
+    np.put_along_axis(ranks, np.argsort(-sample, axis=1, kind="stable"),
+                      np.arange(1, sample.shape[1] + 1, dtype=np.int32)[None, :], axis=1)
+    return sample, ranks
+
+
+def bootstrap(scores: np.ndarray, shown: np.ndarray, ids: np.ndarray, uids: np.ndarray, resamples: int = RESAMPLES,
+              eliminate: float = 0.2, confidence: float = 0.95, processes: int = None,
+              seed: int = None) -> List[Interval]:
+    """Bootstraps the votes to find confidence intervals of every response's score and rank.
+
+    The bottom eliminate fraction of responses is eliminated, and a contestant survives a resample if their best
+    response is above that line. Resamples are computed CHUNK at a time across a pool of processes."""
+    count = len(uids)
+    line = count - int(ceil(count * eliminate))
+    contestants, owner = np.unique(uids, return_inverse=True)
+    chunks = [CHUNK] * (resamples // CHUNK) + ([resamples % CHUNK] if resamples % CHUNK else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    sampled_scores = []
+    sampled_ranks = []
+    survived = np.zeros(len(contestants))
+    # spawn rather than fork, since the bot process has an event loop and the SQL thread running
+    with ProcessPoolExecutor(processes, get_context("spawn"), _init_worker, (scores, shown)) as pool:
+        for sample, ranks in pool.map(_resample, chunks, seeds):
+            sampled_scores.append(sample)
+            sampled_ranks.append(ranks)
+            best = np.full((ranks.shape[0], len(contestants)), count + 1)
+            for r in range(count):
+                best[:, owner[r]] = np.minimum(best[:, owner[r]], ranks[:, r])
+            survived += (best <= line).sum(axis=0)
+    sampled_scores = np.concatenate(sampled_scores)
+    sampled_ranks = np.concatenate(sampled_ranks)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        point = scores.sum(axis=0) / shown.sum(axis=0)
+    point = np.nan_to_num(point, nan=-1.0)
+    point_ranks = np.empty(count, dtype=np.int32)
+    point_ranks[np.argsort(-point, kind="stable")] = np.arange(1, count + 1)
+    tail = (1 - confidence) / 2 * 100
+    score_low, score_high = np.percentile(sampled_scores, [tail, 100 - tail], axis=0)
+    rank_low, rank_high = np.percentile(sampled_ranks, [tail, 100 - tail], axis=0)
+    survival = survived / resamples
+    return sorted((Interval(int(ids[r]), int(uids[r]), float(point[r]), float(score_low[r]), float(score_high[r]),
+                            int(point_ranks[r]), int(rank_low[r]), int(rank_high[r]), float(survival[owner[r]]))
+                   for r in range(count)), key=lambda i: i.rank)
+
+
+def round_intervals(thread: SQLThread, resamples: int = RESAMPLES, eliminate: float = 0.2,
+                    confidence: float = 0.95, processes: int = None) -> List[Interval]:
+    """Bootstraps the current round's Votes, returning the intervals of its Responses best first."""
+    sql_thread_logger.debug("Thread {} is bootstrapping {:d} resamples".format(get_ident(), resamples))
+    responses = get_round_responses_columns(thread)
+    votes = get_votes_columns(thread)
+    if len(responses) == 0 or len(votes) == 0:
+        return []
+    scores, shown = vote_matrix(responses.id, votes)
+    return bootstrap(scores, shown, np.asarray(responses.id), np.asarray(responses.uid), resamples, eliminate,
+                     confidence, processes)
@@ -0,0 +1,164 @@
+import sqlite3
+from array import array
+from typing import List, Tuple, Union, Iterator, Sequence, Set
+
+CHUNK_SIZE = 4096
+"""Number of rows fetched from the cursor at a time while building columns."""
+
+
+class TextColumn(Sequence):
+    """A column of strings stored as one UTF-8 blob with an array of offsets into it.
+    Strings are only decoded when indexed, and NULLs are tracked separately."""
+    offsets: array
+    blob: bytearray
+    nulls: Set[int]
+
+    def __init__(self):
+        self.offsets = array("q", [0])
+        self.blob = bytearray()
+        self.nulls = set()
+
+    def extend(self, values):
+        for value in values:
+            if value is None:
+                self.nulls.add(len(self.offsets) - 1)
+            else:
+                self.blob += value.encode("utf-8")
+            self.offsets.append(len(self.blob))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i in self.nulls:
+            return None
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def nbytes(self) -> int:
+        return self.offsets.itemsize * len(self.offsets) + len(self.blob)
+
+
+class _ColumnBuilder:
+    """Accumulates the values of one column, picking the most compact storage that fits them.
+
+    Integers go in a signed 64-bit array, promoted to a double array if a float shows up.
+    Strings go in a TextColumn. Anything else, including NULLs in a numeric column, falls back to a list."""
+    column: Union[None, array, TextColumn, list]
+    leading_nulls: int
+
+    def __init__(self):
+        self.column = None
+        self.leading_nulls = 0
+
+    def extend(self, values: tuple):
+        if self.column is None:
+            first = next((v for v in values if v is not None), None)
+            if first is None:
+                self.leading_nulls += len(values)
+                return
+            if isinstance(first, str):
+                self.column = TextColumn()
+            elif isinstance(first, int):
+                self.column = array("q")
+            elif isinstance(first, float):
+                self.column = array("d")
+            else:
+                self.column = []
+            if self.leading_nulls:
+                if isinstance(self.column, array):
+                    self.column = []
+                self.column.extend([None] * self.leading_nulls)
+        if isinstance(self.column, TextColumn):
+            if all(v is None or isinstance(v, str) for v in values):
+                self.column.extend(values)
+                return
+            self.column = list(self.column)
+        elif isinstance(self.column, array):
+            try:
+                # convert first so that a failure leaves the column untouched
+                self.column.extend(array(self.column.typecode, values))
+                return
+            except (TypeError, OverflowError):
+                if self.column.typecode == "q" and all(isinstance(v, (int, float)) for v in values):
+                    self.column = array("d", self.column)
+                    self.column.extend(array("d", values))
+                    return
+                self.column = self.column.tolist()
+        self.column.extend(values)
+
+    def build(self) -> Union[array, TextColumn, list]:
+        if self.column is None:
+            return [None] * self.leading_nulls
+        return self.column
+
+
+class ColumnSet:
+    """A column-oriented query result.
+
+    Each column is an array, a TextColumn or, for columns that cannot be stored compactly, a list.
+    Columns are accessible as attributes or by index, and numeric arrays support the buffer protocol,
+    so they can be wrapped without copying."""
+    fields: Tuple[str, ...]
+    columns: List[Union[array, TextColumn, list]]
+
+    def __init__(self, fields: Sequence[str], columns: List[Union[array, TextColumn, list]]):
+        self.fields = tuple(fields)
+        self.columns = columns
+
+    @classmethod
+    def from_cursor(cls, cursor: sqlite3.Cursor, chunk: int = CHUNK_SIZE) -> "ColumnSet":
+        """Builds a ColumnSet from an executed cursor, holding at most chunk rows in memory at a time."""
+        if cursor.description is None:
+            return cls((), [])
+        fields = [d[0] for d in cursor.description]
+        builders = [_ColumnBuilder() for _ in fields]
+        rows = cursor.fetchmany(chunk)
+        while rows:
+            for builder, values in zip(builders, zip(*rows)):
+                builder.extend(values)
+            rows = cursor.fetchmany(chunk)
+        return cls(fields, [b.build() for b in builders])
+
+    def rename(self, fields: Sequence[str]) -> "ColumnSet":
+        """Returns the same columns under new field names, such as the fields of a row namedtuple."""
+        if len(fields) != len(self.columns):
+            raise ValueError("Expected {:d} field names, got {:d}".format(len(self.columns), len(fields)))
+        return ColumnSet(fields, self.columns)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, key: Union[int, str]):
+        if isinstance(key, str):
+            return self.columns[self.fields.index(key)]
+        return self.columns[key]
+
+    def __getattr__(self, name: str):
+        if name in ("fields", "columns"):
+            raise AttributeError(name)
+        try:
+            return self.columns[self.fields.index(name)]
+        except ValueError:
+            raise AttributeError(name)
+
+    def rows(self, ret_tuple=None) -> Iterator[tuple]:
+        """Iterates over the rows, made into ret_tuple if given. This allocates one object per row."""
+        make = tuple if ret_tuple is None else ret_tuple._make
+        for i in range(len(self)):
+            yield make(column[i] for column in self.columns)
+
+    def nbytes(self) -> int:
+        """Approximate memory used by the column data, not counting list fallbacks' elements."""
+        total = 0
+        for column in self.columns:
+            if isinstance(column, array):
+                total += column.itemsize * len(column)
+            elif isinstance(column, TextColumn):
+                total += column.nbytes()
+            else:
+                total += 8 * len(column)
+        return total
@@ -0,0 +1,122 @@
+import logging
+from collections import namedtuple
+from math import log, sqrt
+from threading import get_ident
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .bootstrap import vote_scores
+from .sqlhandle import SQLThread
+from .sqlutils import get_round_responses_columns, get_votes_columns, vid2uid_many
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+BLOCK = 1024
+"""Number of voters compared against each other at a time, which bounds the memory used by the comparison."""
+MIN_OVERLAP = 5
+"""Fewest responses two voters must both have scored for their agreement to count."""
+
+Cluster = namedtuple("Cluster", ["vids", "uids", "pairs", "similarity", "overlap"])
+"""Voters linked by suspiciously similar votes, with the number of flagged pairs among them,
+and the mean similarity and number of responses both voters scored over those pairs."""
+
+
+def preference_matrix(ids, votes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Builds the voters x responses matrices of each voter's preferences and of which responses they scored,
+    returning them with the VID of each row. ids must be in the order screens were dealt from.
+
+    A preference is how much higher than the consensus a voter scored a response, averaged over their votes.
+    Taking out the consensus keeps voters who merely share the popular opinion from looking alike."""
+    vids, rows = np.unique(np.asarray(votes.vid), return_inverse=True)
+    voter, response, score = [], [], []
+    for row, gseed, vote in zip(rows, votes.seed, votes.vote):
+        for r, s in vote_scores(gseed, vote, len(ids)):
+            voter.append(row)
+            response.append(r)
+            score.append(s)
+    voter = np.asarray(voter, dtype=np.intp)
+    response = np.asarray(response, dtype=np.intp)
+    score = np.asarray(score)
+    shown = np.bincount(response, minlength=len(ids))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        consensus = np.bincount(response, score, len(ids)) / shown
+    sums = np.zeros((len(vids), len(ids)))
+    counts = np.zeros((len(vids), len(ids)))
+    np.add.at(sums, (voter, response), score - consensus[response])
+    np.add.at(counts, (voter, response), 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        prefs = np.where(counts > 0, sums / counts, 0)
+    return vids, prefs.astype(np.float32), (counts > 0).astype(np.float32)
+
+
+def similar_pairs(prefs: np.ndarray, scored: np.ndarray, threshold: float = None, min_overlap: int = MIN_OVERLAP,
+                  block: int = BLOCK) -> List[Tuple[int, int, float, int]]:
+    """Finds pairs of rows whose preferences agree more than is plausible by chance,
+    as (row, other row, similarity, overlap) tuples.
+
+    Similarity is the cosine of two voters' preferences over the responses they both scored, and overlap is the
+    number of those responses. For voters who agree only by chance, similarity * sqrt(overlap) is roughly a
+    standard normal, so pairs above threshold on that scale are flagged. The default threshold is the expected
+    largest of that many normals, so that about one pair of honest voters is flagged in a round.
+    Rows are compared block at a time with matrix products, so memory use does not grow with the square of
+    the number of voters."""
+    count = prefs.shape[0]
+    if threshold is None:
+        threshold = max(sqrt(2 * log(max(count * (count - 1) / 2, 2))), 3.0)
+    squares = prefs * prefs
+    pairs = []
+    for start in range(0, count, block):
+        a = slice(start, min(start + block, count))
+        for other in range(start, count, block):
+            b = slice(other, min(other + block, count))
+            overlap = scored[a] @ scored[b].T
+            agreement = prefs[a] @ prefs[b].T
+            norms = (squares[a] @ scored[b].T) * (scored[a] @ squares[b].T)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                similarity = agreement / np.sqrt(norms)
+                flagged = (overlap >= min_overlap) & (similarity * np.sqrt(overlap) > threshold)
+            if other == start:
+                # each pair once, and no voter against themselves
+                flagged &= np.triu(np.ones(flagged.shape, dtype=bool), 1)
+            for i, j in zip(*np.nonzero(flagged)):
+                pairs.append((start + int(i), other + int(j), float(similarity[i, j]), int(overlap[i, j])))
+    return pairs
+
+
+def clusters(pairs: List[Tuple[int, int, float, int]]) -> List[List[Tuple[int, int, float, int]]]:
+    """Groups flagged pairs into connected clusters of rows, largest first."""
+    parent: Dict[int, int] = dict()
+
+    def find(i: int) -> int:
+        while parent.setdefault(i, i) != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j, _, _ in pairs:
+        parent[find(i)] = find(j)
+    found: Dict[int, list] = dict()
+    for pair in pairs:
+        found.setdefault(find(pair[0]), []).append(pair)
+    return sorted(found.values(), key=lambda c: -len(c))
+
+
+def round_clusters(thread: SQLThread, threshold: float = None, min_overlap: int = MIN_OVERLAP,
+                   block: int = BLOCK) -> List[Cluster]:
+    """Finds clusters of voters whose votes in the current round agree more than is plausible, largest first."""
+    sql_thread_logger.debug("Thread {} is correlating voters".format(get_ident()))
+    responses = get_round_responses_columns(thread)
+    votes = get_votes_columns(thread)
+    if len(responses) == 0 or len(votes) == 0:
+        return []
+    vids, prefs, scored = preference_matrix(responses.id, votes)
+    found = clusters(similar_pairs(prefs, scored, threshold, min_overlap, block))
+    uids = vid2uid_many(thread, [int(vids[i]) for cluster in found for pair in cluster for i in pair[:2]])
+    result = []
+    for cluster in found:
+        members = sorted({int(vids[i]) for pair in cluster for i in pair[:2]})
+        result.append(Cluster(members, [uids.get(vid) for vid in members], len(cluster),
+                              sum(pair[2] for pair in cluster) / len(cluster),
+                              sum(pair[3] for pair in cluster) / len(cluster)))
+    return result
@@ -0,0 +1,100 @@
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import sqlite3
+from threading import get_ident
+from typing import TextIO, Tuple
+from urllib.request import pathname2url
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+EXPORT_TABLES = {
+    "archive": ("ResponseArchive", "roundNum"),
+    "votes": ("Votes", None),
+    "members": ("Members", None),
+    "responses": ("Responses", None),
+}
+"""Exportable tables by name, with the column to filter on when exporting a single round, if any."""
+
+FORMATS = ["csv", "jsonl"]
+
+CHUNK_SIZE = 1024
+"""Number of rows read at a time while exporting, each in its own short read transaction."""
+
+
+class InvalidExportError(Exception):
+    pass
+
+
+def _open(filename: str, compress: bool) -> TextIO:
+    if compress:
+        return gzip.open(filename, "wt", encoding="utf-8", newline="")
+    return open(filename, "w", encoding="utf-8", newline="")
+
+
+def export_table(db: str, table: str, filename: str, fmt: str = "csv", compress: bool = False,
+                 round_num: int = None) -> Tuple[str, int]:
+    """Streams a table to a CSV or JSON Lines file, optionally gzipped, and returns the filename and row count.
+
+    Reads through its own read-only connection to db, CHUNK_SIZE rows at a time in order of rowid, so memory use
+    does not depend on the size of the table. Each chunk is its own read transaction, so writes by the bot are
+    never locked out for the length of the export, and rows changed during it may or may not be included.
+    The extension of the file is appended automatically.
+    Raises InvalidExportError if the table or format is unknown, or a round is given for a table without rounds."""
+    if table not in EXPORT_TABLES:
+        raise InvalidExportError("Unknown table {}. Expected one of {}".format(table, ", ".join(EXPORT_TABLES)))
+    if fmt not in FORMATS:
+        raise InvalidExportError("Unknown format {}. Expected one of {}".format(fmt, ", ".join(FORMATS)))
+    name, round_col = EXPORT_TABLES[table]
+    if round_num is not None and round_col is None:
+        raise InvalidExportError("Table {} cannot be exported by round".format(table))
+    filename += "." + fmt + (".gz" if compress else "")
+    sql_thread_logger.debug("Thread {} is exporting {} to file {}".format(get_ident(), name, filename))
+    conn = sqlite3.connect("file:{}?mode=ro".format(pathname2url(db)), uri=True)
+    if round_num is None:
+        statement = "SELECT rowid, * FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?;".format(name)
+    else:
+        statement = "SELECT rowid, * FROM {} WHERE {} = ? AND rowid > ? ORDER BY rowid LIMIT ?;".format(
+            name, round_col)
+    params = () if round_num is None else (round_num,)
+    count = 0
+    try:
+        # fetching every row of a chunk finishes its statement, which ends its read transaction
+        cursor = conn.execute(statement, params + (-(1 << 63), CHUNK_SIZE))
+        fields = [d[0] for d in cursor.description][1:]
+        rows = cursor.fetchall()
+        with _open(filename, compress) as f:
+            if fmt == "csv":
+                writer = csv.writer(f)
+                writer.writerow(fields)
+            while rows:
+                if fmt == "csv":
+                    writer.writerows(row[1:] for row in rows)
+                else:
+                    f.writelines(json.dumps(dict(zip(fields, row[1:])), ensure_ascii=False) + "\n" for row in rows)
+                count += len(rows)
+                rows = conn.execute(statement, params + (rows[-1][0], CHUNK_SIZE)).fetchall()
+    except Exception:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    finally:
+        conn.close()
+    sql_thread_logger.debug("Exported {:d} rows of {} to file {}".format(count, name, filename))
+    return filename, count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a table of the mTWOW database to CSV or JSON Lines.")
+    parser.add_argument("db", help="Database file.")
+    parser.add_argument("table", choices=list(EXPORT_TABLES))
+    parser.add_argument("filename", help="Output file, without extension.")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="csv")
+    parser.add_argument("-z", "--gzip", action="store_true", help="Compress the output with gzip.")
+    parser.add_argument("-r", "--round", type=int, default=None, help="Only export this round of the archive.")
+    args = parser.parse_args()
+    out, rows = export_table(args.db, args.table, args.filename, args.format, args.gzip, args.round)
+    print("Exported {:d} rows to {}".format(rows, out))
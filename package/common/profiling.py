@@ -0,0 +1,197 @@
+import cProfile
+import logging
+import pstats
+import sys
+from collections import Counter, namedtuple
+from threading import Thread, Event, get_ident
+from time import perf_counter
+from typing import Dict, List, Optional
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+SAMPLE_INTERVAL = 0.005
+"""Seconds between stack samples."""
+MAX_DEPTH = 64
+"""Deepest call stack written when turning a cProfile into collapsed stacks."""
+
+CommandTiming = namedtuple("CommandTiming", ["command", "count", "total", "max"])
+
+
+def _frame_name(code) -> str:
+    return "{}:{}:{:d}".format(code.co_filename.rsplit("/", 1)[-1], code.co_name, code.co_firstlineno)
+
+
+class StackSampler(Thread):
+    """A thread that periodically samples the call stacks of other threads, by name.
+    Stacks are counted in the collapsed format read by flamegraph tools."""
+    def __init__(self, threads: Dict[str, int], interval: float = SAMPLE_INTERVAL):
+        Thread.__init__(self, daemon=True)
+        self.stopped = Event()
+        self.threads = threads
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self):
+        sql_thread_logger.debug("Stack sampler thread {}".format(get_ident()))
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for name, ident in self.threads.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(name)
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> List[str]:
+        return ["{} {:d}".format(stack, n) for stack, n in self.stacks.most_common()]
+
+
+def collapse_profile(profile: cProfile.Profile, name: str) -> List[str]:
+    """Turns a cProfile into collapsed stacks weighted by microseconds.
+
+    cProfile only records caller and callee pairs, so a function's time is split among the paths that reach it
+    in proportion to the time each of its callers spent in it."""
+    stats = pstats.Stats(profile).stats
+    callees = dict()
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge))
+    lines = Counter()
+
+    def label(func) -> str:
+        return "{}:{}:{:d}".format(func[0].rsplit("/", 1)[-1], func[2], func[1])
+
+    def walk(func, path: List[str], total: float, self_time: float):
+        if total < 0.000001:
+            return
+        path = path + [label(func)]
+        if self_time > 0:
+            lines[";".join(path)] += int(self_time * 1000000)
+        if len(path) >= MAX_DEPTH:
+            return
+        cumulative = stats[func][3]
+        if cumulative <= 0:
+            return
+        for callee, (_, _, tt, ct) in callees.get(func, []):
+            if callee == func or label(callee) in path:
+                continue
+            share = total / cumulative
+            walk(callee, path, ct * share, tt * share)
+
+    for func, (_, _, tt, ct, callers) in stats.items():
+        if not callers:
+            walk(func, [name], ct, tt)
+    return ["{} {:d}".format(stack, n) for stack, n in lines.most_common() if n > 0]
+
+
+class CommandTimer:
+    """Times command invocations while enabled. When disabled, the hooks return immediately."""
+    enabled: bool
+    _starts: Dict[int, float]
+    _timings: Dict[str, List[float]]
+
+    def __init__(self):
+        self.enabled = False
+        self._starts = dict()
+        self._timings = dict()
+
+    async def before(self, ctx):
+        if self.enabled:
+            self._starts[id(ctx)] = perf_counter()
+
+    async def after(self, ctx):
+        if self.enabled:
+            start = self._starts.pop(id(ctx), None)
+            if start is not None:
+                self._timings.setdefault(ctx.command.qualified_name, []).append(perf_counter() - start)
+
+    def reset(self):
+        self._starts.clear()
+        self._timings.clear()
+
+    def timings(self) -> List[CommandTiming]:
+        """Timings of each command, slowest in total first."""
+        return sorted((CommandTiming(command, len(times), sum(times), max(times))
+                       for command, times in self._timings.items()), key=lambda t: -t.total)
+
+
+class ProfileSession:
+    """A window of profiling of the event loop thread and the SQLThread worker.
+
+    In "sample" mode, a StackSampler samples both threads. In "cprofile" mode, the event loop is profiled with
+    cProfile directly, and the SQLThread worker profiles the operations it runs with its own cProfile.
+    Command timing is enabled for the length of the session in both modes."""
+    MODES = ["sample", "cprofile"]
+
+    def __init__(self, mode: str, loop_thread: int, sqlthread, timer: CommandTimer):
+        if mode not in self.MODES:
+            raise ValueError("Unknown profiling mode {}. Expected one of {}".format(mode, ", ".join(self.MODES)))
+        self.mode = mode
+        self.sqlthread = sqlthread
+        self.timer = timer
+        self.sampler: Optional[StackSampler] = None
+        self.loop_profile: Optional[cProfile.Profile] = None
+        self.sql_profile: Optional[cProfile.Profile] = None
+        self.loop_thread = loop_thread
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    def start(self):
+        """Starts profiling. In cprofile mode, this must be called from the event loop thread."""
+        self.timer.reset()
+        self.timer.enabled = True
+        self.started = perf_counter()
+        if self.mode == "sample":
+            self.sampler = StackSampler({"event_loop": self.loop_thread, "sqlthread": self.sqlthread.ident})
+            self.sampler.start()
+        else:
+            self.sql_profile = cProfile.Profile()
+            self.sqlthread.profiler = self.sql_profile
+            self.loop_profile = cProfile.Profile()
+            self.loop_profile.enable()
+
+    def stop(self):
+        """Stops profiling. In cprofile mode, this must be called from the event loop thread."""
+        self.elapsed = perf_counter() - self.started
+        self.timer.enabled = False
+        if self.sampler is not None:
+            self.sampler.stopped.set()
+            self.sampler.join()
+        if self.loop_profile is not None:
+            self.loop_profile.disable()
+            self.sqlthread.profiler = None
+
+    def write(self, filename: str) -> str:
+        """Writes the collapsed stacks to filename + ".folded" and returns that filename.
+        In cprofile mode, the raw profiles are also written to .loop.pstats and .sql.pstats files."""
+        if self.sampler is not None:
+            lines = self.sampler.collapsed()
+        else:
+            lines = collapse_profile(self.loop_profile, "event_loop")
+            self.loop_profile.dump_stats(filename + ".loop.pstats")
+            with self.sqlthread.sql_resource:
+                # the worker only touches its profile while holding sql_resource
+                if self.sql_profile.getstats():
+                    lines += collapse_profile(self.sql_profile, "sqlthread")
+                    self.sql_profile.dump_stats(filename + ".sql.pstats")
+        filename += ".folded"
+        with open(filename, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in lines)
+        return filename
+
+    def summary(self) -> List[str]:
+        """Describes the session and the timing of each command invoked during it."""
+        lines = ["Profiled for {:.1f}s in {} mode.".format(self.elapsed, self.mode)]
+        if self.sampler is not None:
+            lines[0] += " Took {:d} samples.".format(self.sampler.samples)
+        for timing in self.timer.timings():
+            lines.append("{}: {:d} calls, {:.1f}ms total, {:.1f}ms mean, {:.1f}ms max".format(
+                timing.command, timing.count, timing.total * 1000, timing.total / timing.count * 1000,
+                timing.max * 1000))
+        return lines
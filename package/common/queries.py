@@ -0,0 +1,77 @@
+import logging
+from collections import namedtuple
+from threading import get_ident
+from typing import Dict, List, Tuple
+
+from .sqlhandle import SQLThread, NamedQuery, PRIORITY_HIGH, PRIORITY_NORMAL
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+Query = namedtuple("Query", ["name", "statement", "ret_tuple", "tables", "columnar", "priority"])
+"""A registered query. ret_tuple is the named tuple its rows are cast to, if any,
+and tables are the tables it reads or writes."""
+
+QUERIES: Dict[str, Query] = dict()
+"""Every registered query, by name."""
+
+
+class InvalidQueryError(Exception):
+    pass
+
+
+def register_query(name: str, statement: str, ret_tuple=None, tables: Tuple[str, ...] = (), columnar: bool = False,
+                   priority: int = PRIORITY_NORMAL) -> Query:
+    """Registers a query under a name, to be run with run_query.
+    Statements must only use ? placeholders, and a columnar query's result is a ColumnSet."""
+    query = Query(name, statement, ret_tuple, tuple(tables), columnar, priority)
+    if name in QUERIES and QUERIES[name] != query:
+        raise InvalidQueryError("A different query is already registered as {}".format(name))
+    QUERIES[name] = query
+    return query
+
+
+def run_query(thread: SQLThread, name: str, params: tuple = (), priority: int = None, timeout: float = None):
+    """Runs a registered query, at its registered priority unless one is given.
+
+    Rows are cast to the query's named tuple if it has one, and columnar results have their columns named after
+    its fields. Raises any error the query failed with."""
+    query = QUERIES[name]
+    res = thread.execute(NamedQuery(name, query.statement, tuple(params), query.columnar),
+                         query.priority if priority is None else priority, timeout)
+    if isinstance(res, Exception):
+        raise res
+    if query.ret_tuple is None:
+        return res
+    if query.columnar:
+        return res.rename(query.ret_tuple._fields)
+    return map(query.ret_tuple._make, res)
+
+
+def validate_queries(thread: SQLThread) -> int:
+    """Compiles every registered query with EXPLAIN against the schema, and checks that it only opens the tables it
+    declares. Returns the number of queries checked, or raises InvalidQueryError describing every invalid one."""
+    sql_thread_logger.debug("Thread {} is validating {:d} queries".format(get_ident(), len(QUERIES)))
+    res = thread.execute(("SELECT name, tbl_name, rootpage, type FROM sqlite_master;", ()), PRIORITY_HIGH)
+    if isinstance(res, Exception):
+        raise res
+    tables = {name for name, _, _, kind in res if kind == "table"}
+    pages = dict((rootpage, table) for _, table, rootpage, _ in res if rootpage)
+    errors: List[str] = []
+    for query in QUERIES.values():
+        unknown = [table for table in query.tables if table not in tables]
+        if unknown:
+            errors.append("{}: declares unknown tables {}".format(query.name, ", ".join(unknown)))
+            continue
+        plan = thread.execute(("EXPLAIN " + query.statement, (None,) * query.statement.count("?")), PRIORITY_HIGH)
+        if isinstance(plan, Exception):
+            errors.append("{}: {}".format(query.name, plan))
+            continue
+        # OpenRead and OpenWrite take the root page of the table or index in p2, and the database in p3
+        opened = {pages.get(p2) for _, opcode, _, p2, p3, *_ in plan if opcode in ("OpenRead", "OpenWrite") and p3 == 0}
+        undeclared = sorted(table for table in opened if table is not None and table not in query.tables)
+        if undeclared:
+            errors.append("{}: touches undeclared tables {}".format(query.name, ", ".join(undeclared)))
+    if errors:
+        raise InvalidQueryError("Invalid queries:\n" + "\n".join(errors))
+    sql_thread_logger.debug("Validated {:d} queries".format(len(QUERIES)))
+    return len(QUERIES)
@@ -0,0 +1,273 @@
+import logging
+import sqlite3
+from array import array
+from collections import namedtuple, deque
+from random import Random
+from secrets import token_hex
+from string import ascii_uppercase
+from threading import Lock, get_ident
+from typing import Dict, Tuple, Optional, Deque, List
+
+from .columns import ColumnSet
+from .sqlhandle import SQLThread
+from .sqlutils import get_round_responses_columns
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+SCREEN_SIZE = 10
+"""Default number of responses on a voting screen."""
+
+Screen = namedtuple("Screen", ["gseed", "ids", "text"])
+
+
+def deal_screen(gseed: str, count: int, size: int = SCREEN_SIZE) -> List[int]:
+    """Picks the indices, out of count responses, shown on the screen with this gseed.
+    The same gseed and responses always give the same screen."""
+    return Random(gseed).sample(range(count), min(size, count, len(ascii_uppercase)))
+
+
+def render_screen(gseed: str, prompt: Optional[str], responses: List[str]) -> str:
+    """Formats the message text of a voting screen."""
+    lines = ["**Screen {}**".format(gseed)]
+    if prompt:
+        lines.append(prompt)
+    lines.extend("**{}** {}".format(letter, response) for letter, response in zip(ascii_uppercase, responses))
+    return "\n".join(lines)
+
+
+class ScreenCache:
+    """A store of pre-rendered voting screens, keyed by gseed.
+
+    Screens are kept in memory as encoded bytes until memory_limit bytes are used, after which further
+    screens spill to a SQLite database. Screens that have not been handed out yet are kept in
+    the order they were added, and the VID of the voter each screen was handed out to is kept.
+
+    The gseed and owner of every screen and the round's prompt are also recorded in the spill database, so a
+    cache opened on the same file after a restart still knows the round's screens. Those kept in memory are
+    lost with it, and are rendered again by restore_screens."""
+    _memory: Dict[str, Tuple[bytes, bytes]]
+    _unassigned: Deque[str]
+    _owners: Dict[str, int]
+    prompt: Optional[str]
+    responses: Optional[ColumnSet]
+    _spill: sqlite3.Connection
+    lock: Lock
+    memory_limit: int
+    memory_used: int
+    spilled: int
+    hits: int
+    misses: int
+
+    def __init__(self, memory_limit: int = 32 * 1024 * 1024, spill_db: str = ""):
+        """Constructs a cache holding the screens recorded in spill_db, if any.
+        The default spill_db of "" is a temporary database deleted on close."""
+        self._memory = dict()
+        self._unassigned = deque()
+        self._owners = dict()
+        self.responses = None
+        """The current round's responses screens are dealt from, so screens rendered on demand need not fetch them.
+        None until prerender or restore_screens loads them."""
+        self._spill = sqlite3.Connection(spill_db, check_same_thread=False, isolation_level=None)
+        # records only need to survive the bot restarting, so commits are not synced to disk
+        self._spill.execute("PRAGMA journal_mode = WAL;")
+        self._spill.execute("PRAGMA synchronous = NORMAL;")
+        self._spill.executescript("""CREATE TABLE IF NOT EXISTS Screens (
+            gseed TEXT PRIMARY KEY NOT NULL,
+            ids BLOB NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS Seeds (
+            gseed TEXT PRIMARY KEY NOT NULL,
+            owner INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS Round (
+            id INTEGER PRIMARY KEY NOT NULL CHECK (id = 0),
+            prompt TEXT
+        );""")
+        row = self._spill.execute("SELECT prompt FROM Round;").fetchone()
+        self.prompt = None if row is None else row[0]
+        """Prompt the cached screens were rendered with, so screens rendered on demand match them."""
+        for gseed, owner in self._spill.execute("SELECT gseed, owner FROM Seeds ORDER BY rowid;"):
+            if owner is None:
+                self._unassigned.append(gseed)
+            else:
+                self._owners[gseed] = owner
+        self.lock = Lock()
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.spilled = self._spill.execute("SELECT count(*) FROM Screens;").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._memory) + self.spilled
+
+    def _store(self, gseed: str, ids: List[int], text: str):
+        ids = array("q", ids).tobytes()
+        text = text.encode("utf-8")
+        size = len(gseed) + len(ids) + len(text)
+        if self.memory_used + size <= self.memory_limit:
+            self._memory[gseed] = (ids, text)
+            self.memory_used += size
+        else:
+            self._spill.execute("INSERT OR REPLACE INTO Screens VALUES (?, ?, ?);", (gseed, ids, text))
+            self.spilled += 1
+
+    def open_round(self, prompt: Optional[str], responses: ColumnSet):
+        """Empties the cache for a round with this prompt, whose screens are dealt from responses."""
+        self.clear()
+        with self.lock:
+            self.prompt = prompt
+            self.responses = responses
+            self._spill.execute("INSERT OR REPLACE INTO Round VALUES (0, ?);", (prompt,))
+
+    def put(self, screen: Screen, owner: int = None):
+        """Adds a screen. Unless it was already handed out to the voter with VID owner, it will be handed out by
+        take."""
+        with self.lock:
+            self._store(screen.gseed, screen.ids, screen.text)
+            self._spill.execute("INSERT OR REPLACE INTO Seeds VALUES (?, ?);", (screen.gseed, owner))
+            if owner is None:
+                self._unassigned.append(screen.gseed)
+            else:
+                self._owners[screen.gseed] = owner
+
+    def missing(self) -> List[str]:
+        """gseeds of the screens recorded in the spill database that are not in the cache,
+        such as those that were kept in memory before a restart."""
+        with self.lock:
+            return [gseed for gseed, in self._spill.execute(
+                "SELECT gseed FROM Seeds WHERE gseed NOT IN (SELECT gseed FROM Screens) ORDER BY rowid;")
+                if gseed not in self._memory]
+
+    def restore(self, screen: Screen):
+        """Puts back a screen recorded in the spill database, keeping whether and to whom it was handed out."""
+        with self.lock:
+            self._store(screen.gseed, screen.ids, screen.text)
+
+    def get(self, gseed: str) -> Optional[Screen]:
+        """Looks up a screen by gseed, counting a hit or a miss."""
+        return self._lookup(gseed, True)
+
+    def peek(self, gseed: str) -> Optional[Screen]:
+        """Looks up a screen by gseed without counting it in the hit rate, such as to check a vote against it."""
+        return self._lookup(gseed, False)
+
+    def owner(self, gseed: str) -> Optional[int]:
+        """The VID of the voter a screen was handed out to, or None if it has not been handed out."""
+        with self.lock:
+            return self._owners.get(gseed)
+
+    def _lookup(self, gseed: str, count: bool) -> Optional[Screen]:
+        with self.lock:
+            entry = self._memory.get(gseed)
+            if entry is None and self.spilled:
+                entry = self._spill.execute("SELECT ids, text FROM Screens WHERE gseed = ?;", (gseed,)).fetchone()
+            if count:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if entry is None:
+                return None
+        ids = array("q")
+        ids.frombytes(entry[0])
+        return Screen(gseed, ids.tolist(), bytes(entry[1]).decode("utf-8"))
+
+    def take(self, vid: int) -> Optional[Screen]:
+        """Hands out the next screen nobody has received yet to the voter with this VID,
+        or returns None if all have been handed out."""
+        with self.lock:
+            gseed = self._unassigned.popleft() if self._unassigned else None
+            if gseed is None:
+                self.misses += 1
+                return None
+            self._owners[gseed] = vid
+            self._spill.execute("UPDATE Seeds SET owner = ? WHERE gseed = ?;", (vid, gseed))
+        return self.get(gseed)
+
+    def clear(self):
+        with self.lock:
+            self._memory.clear()
+            self._unassigned.clear()
+            self._owners.clear()
+            self.prompt = None
+            self.responses = None
+            self._spill.execute("DELETE FROM Screens;")
+            self._spill.execute("DELETE FROM Seeds;")
+            self._spill.execute("DELETE FROM Round;")
+            self.memory_used = 0
+            self.spilled = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "screens": len(self._memory) + self.spilled,
+                "in_memory": len(self._memory),
+                "spilled": self.spilled,
+                "unassigned": len(self._unassigned),
+                "memory_used": self.memory_used,
+                "memory_limit": self.memory_limit,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+def render(gseed: str, ids, texts, prompt: str = None, size: int = SCREEN_SIZE) -> Screen:
+    """Builds the screen with this gseed out of parallel sequences of response ids and texts."""
+    picks = deal_screen(gseed, len(ids), size)
+    return Screen(gseed, [ids[i] for i in picks], render_screen(gseed, prompt, [texts[i] for i in picks]))
+
+
+def _responses(thread: SQLThread, cache: ScreenCache) -> ColumnSet:
+    """The responses of the round the cache holds, fetched only if it has not loaded them yet."""
+    responses = cache.responses
+    if responses is None:
+        responses = cache.responses = get_round_responses_columns(thread)
+    return responses
+
+
+def prerender(thread: SQLThread, cache: ScreenCache, count: int, prompt: str = None,
+              size: int = SCREEN_SIZE) -> int:
+    """Renders count screens from the current round's Responses into an emptied cache.
+    Returns the number of screens rendered, which is 0 if there are no responses."""
+    sql_thread_logger.debug("Thread {} is prerendering {:d} screens".format(get_ident(), count))
+    responses = get_round_responses_columns(thread)
+    cache.open_round(prompt, responses)
+    if len(responses) == 0:
+        return 0
+    for _ in range(count):
+        cache.put(render(token_hex(8), responses.id, responses.response, prompt, size))
+    sql_thread_logger.debug("Prerendered {:d} screens".format(count))
+    return count
+
+
+def restore_screens(thread: SQLThread, cache: ScreenCache, size: int = SCREEN_SIZE) -> int:
+    """Renders again the screens the cache recorded in its spill database but no longer holds, such as after a
+    restart, from the current round's Responses. Returns the number of screens restored."""
+    missing = cache.missing()
+    if not missing:
+        return 0
+    sql_thread_logger.debug("Thread {} is restoring {:d} screens".format(get_ident(), len(missing)))
+    responses = _responses(thread, cache)
+    for gseed in missing:
+        cache.restore(render(gseed, responses.id, responses.response, cache.prompt, size))
+    return len(missing)
+
+
+def next_screen(thread: SQLThread, cache: ScreenCache, vid: int, size: int = SCREEN_SIZE) -> Optional[Screen]:
+    """Hands out a pre-rendered screen to the voter with this VID, rendering one on demand from the round's
+    responses and prompt if the cache has run out. Returns None if there are no responses to vote on."""
+    screen = cache.take(vid)
+    if screen is not None:
+        return screen
+    responses = _responses(thread, cache)
+    if len(responses) == 0:
+        return None
+    screen = render(token_hex(8), responses.id, responses.response, cache.prompt, size)
+    cache.put(screen, vid)
+    return screen
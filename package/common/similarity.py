@@ -0,0 +1,59 @@
+import re
+import struct
+from array import array
+from hashlib import blake2b
+from typing import List, Tuple
+
+SHINGLE_SIZE = 4
+"""Length of the character shingles responses are broken into."""
+NUM_HASHES = 32
+"""Length of a MinHash signature. Each blake2b digest provides 16 hashes."""
+BANDS = 8
+"""Number of LSH bands. Responses sharing all hashes of any one band are candidate duplicates.
+With NUM_HASHES // BANDS = 4 hashes per band, pairs above about 0.6 similarity are very likely to be candidates."""
+ROWS = NUM_HASHES // BANDS
+
+_normalize = re.compile(r"[\W_]+")
+
+
+def shingles(text: str) -> set:
+    """Breaks a response into overlapping character shingles, ignoring case, punctuation and spacing."""
+    text = _normalize.sub(" ", text.lower()).strip()
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def signature(text: str) -> array:
+    """Computes the MinHash signature of a response."""
+    hashes = []
+    for shingle in shingles(text or ""):
+        data = shingle.encode("utf-8")
+        hashes.append(struct.unpack("16I", blake2b(data, digest_size=64).digest())
+                      + struct.unpack("16I", blake2b(data, digest_size=64, person=b"mtwow").digest()))
+    return array("I", [min(column) for column in zip(*hashes)])
+
+
+def similarity(a: array, b: array) -> float:
+    """Estimates the Jaccard similarity of two responses from their signatures."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+
+def buckets(sig: array) -> List[int]:
+    """Hashes each band of a signature into a bucket."""
+    return [int.from_bytes(blake2b(sig[i * ROWS:(i + 1) * ROWS].tobytes(), digest_size=8).digest(),
+                           "little", signed=True) for i in range(BANDS)]
+
+
+def index_statements(text: str, rid: int = None) -> List[Tuple[str, tuple]]:
+    """Builds the statements that add a response to the similarity index.
+    If rid is None, they index the response most recently inserted into Responses."""
+    sig = signature(text)
+    if rid is None:
+        ref, key = "(SELECT seq FROM sqlite_sequence WHERE name = 'Responses')", ()
+    else:
+        ref, key = "?", (rid,)
+    statements = [("INSERT OR REPLACE INTO ResponseSignatures VALUES ({}, ?);".format(ref), key + (sig.tobytes(),))]
+    statements.extend(("INSERT INTO ResponseBands VALUES (?, ?, {});".format(ref), (band, bucket) + key)
+                      for band, bucket in enumerate(buckets(sig)))
+    return statements
@@ -0,0 +1,199 @@
+import json
+import logging
+import mmap
+import os
+import sys
+from array import array
+from glob import glob
+from itertools import groupby
+from threading import get_ident
+from typing import Dict, Iterator, List, Tuple
+
+from .columns import TextColumn
+from .sqlhandle import SQLThread
+from .sqlutils import Result, fingerprint_archive_through, get_archive_since_columns
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+VERSION = 1
+"""Version of the snapshot format."""
+NUMERIC_COLUMNS = [("round_num", "q"), ("id", "q"), ("uid", "q"), ("rid", "q"), ("rank", "q"), ("score", "d"),
+                   ("skew", "d")]
+"""The numeric columns of a snapshot, with the array typecode each is stored as."""
+
+
+class InvalidSnapshotError(Exception):
+    pass
+
+
+def _filename(path: str, name: str, generation: int) -> str:
+    return os.path.join(path, "{}.{:d}.bin".format(name, generation))
+
+
+def _empty_meta(generation: int = 0) -> dict:
+    return {"version": VERSION, "byteorder": sys.byteorder, "generation": generation, "count": 0, "blob": 0,
+            "rounds": [], "fingerprint": None}
+
+
+def _read_meta(path: str) -> dict:
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    if meta.get("version") != VERSION:
+        raise InvalidSnapshotError("Snapshot at {} has version {}, expected {:d}".format(
+            path, meta.get("version"), VERSION))
+    if meta["byteorder"] != sys.byteorder:
+        raise InvalidSnapshotError("Snapshot at {} was written on a {} endian machine".format(path, meta["byteorder"]))
+    return meta
+
+
+def _append(filename: str, size: int, data):
+    """Appends data to a file after truncating it to size bytes, dropping anything a failed refresh left behind."""
+    with open(filename, "ab") as f:
+        f.truncate(size)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def refresh_snapshot(thread: SQLThread, path: str) -> int:
+    """Brings the snapshot in directory path up to date with ResponseArchive. Returns the number of rows written.
+
+    Rounds archived since the last refresh are appended to the column files. If rows of rounds already in the
+    snapshot were added, removed, rescored or reranked since, as told by fingerprint_archive_through, it is
+    rewritten under a new generation of files instead, so that readers of the old files are unaffected. meta.json is only replaced once the column files are on disk, so a failed
+    refresh leaves the previous snapshot readable."""
+    sql_thread_logger.debug("Thread {} is refreshing the archive snapshot in {}".format(get_ident(), path))
+    os.makedirs(path, exist_ok=True)
+    try:
+        meta = _read_meta(path)
+    except FileNotFoundError:
+        meta = _empty_meta()
+    except InvalidSnapshotError:
+        meta = _empty_meta(1)
+    last = meta["rounds"][-1][0] if meta["rounds"] else None
+    rebuild = last is not None and fingerprint_archive_through(thread, last) != meta.get("fingerprint")
+    if rebuild:
+        sql_thread_logger.warning("Archived rounds changed since the last snapshot, rewriting it")
+        meta = _empty_meta(meta["generation"] + 1)
+        last = None
+    # taken before reading, so rows archived in between make the next refresh rewrite rather than go unnoticed
+    fingerprint = fingerprint_archive_through(thread, (1 << 63) - 1)
+    columns = get_archive_since_columns(thread, -(1 << 63) if last is None else last)
+    count = len(columns)
+    if count == 0 and os.path.exists(os.path.join(path, "meta.json")) and not rebuild:
+        return 0
+    generation = meta["generation"]
+    for name, typecode in NUMERIC_COLUMNS:
+        values = array(typecode, columns[name]) if count else array(typecode)
+        _append(_filename(path, name, generation), meta["count"] * values.itemsize, values.tobytes())
+    text = columns.response if count else TextColumn()
+    if not isinstance(text, TextColumn):
+        text = TextColumn()
+        text.extend(columns.response)
+    offsets = array("q", [0] if meta["count"] == 0 else [])
+    offsets.extend(meta["blob"] + offset for offset in text.offsets[1:])
+    first_offset = 0 if meta["count"] == 0 else (meta["count"] + 1) * offsets.itemsize
+    _append(_filename(path, "response.offsets", generation), first_offset, offsets.tobytes())
+    _append(_filename(path, "response.blob", generation), meta["blob"], bytes(text.blob))
+    start = meta["count"]
+    for round_num, rows in groupby(columns.round_num if count else []):
+        stop = start + len(list(rows))
+        meta["rounds"].append([round_num, start, stop])
+        start = stop
+    meta["count"] += count
+    meta["blob"] += len(text.blob)
+    meta["fingerprint"] = fingerprint
+    with open(os.path.join(path, "meta.json.tmp"), "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+    for filename in glob(os.path.join(path, "*.bin")):
+        # unlinking a file leaves it mapped for readers still using an older generation
+        if int(filename.rsplit(".", 2)[1]) != generation:
+            os.remove(filename)
+    sql_thread_logger.debug("Wrote {:d} rows to the archive snapshot".format(count))
+    return count
+
+
+class ArchiveSnapshot:
+    """A read-only, memory-mapped view of an archive snapshot.
+
+    Numeric columns are memoryviews straight over the mapped files, so they are never copied into Python, and
+    processes opening the same snapshot share its pages. numpy can wrap them without copying with np.frombuffer.
+    Response text is decoded from the blob one row at a time. The views must not be used after close."""
+    count: int
+    rounds: Dict[int, Tuple[int, int]]
+    columns: Dict[str, memoryview]
+    offsets: memoryview
+    blob: memoryview
+    _maps: List[mmap.mmap]
+    _views: List[memoryview]
+
+    def __init__(self, path: str):
+        try:
+            meta = _read_meta(path)
+        except FileNotFoundError:
+            raise InvalidSnapshotError("No snapshot at {}".format(path))
+        self.path = path
+        self.count = meta["count"]
+        self.rounds = dict((round_num, (start, stop)) for round_num, start, stop in meta["rounds"])
+        self._maps = []
+        self._views = []
+        generation = meta["generation"]
+        self.columns = dict()
+        for name, typecode in NUMERIC_COLUMNS:
+            self.columns[name] = self._map(_filename(path, name, generation), typecode, self.count)
+        self.offsets = self._map(_filename(path, "response.offsets", generation), "q", self.count + 1)
+        self.blob = self._map(_filename(path, "response.blob", generation), "B", meta["blob"])
+
+    def _map(self, filename: str, typecode: str, length: int) -> memoryview:
+        size = length * array(typecode).itemsize
+        if size == 0:
+            # empty files cannot be mapped
+            view = memoryview(array(typecode))
+        else:
+            with open(filename, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._maps.append(mapped)
+            view = memoryview(mapped).cast(typecode)
+        self._views.append(view)
+        return view
+
+    def __len__(self):
+        return self.count
+
+    def __getattr__(self, name: str) -> memoryview:
+        if name == "columns":
+            raise AttributeError(name)
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def response(self, i: int) -> str:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def round(self, round_num: int) -> range:
+        """Rows of a round, best ranked first. Empty if the round is not in the snapshot."""
+        return range(*self.rounds.get(round_num, (0, 0)))
+
+    def rows(self, rows: range = None) -> Iterator[Result]:
+        """Iterates over rows as Results, all of them unless a range is given. This allocates one object per row."""
+        for i in range(self.count) if rows is None else rows:
+            yield Result(self.round_num[i], self.id[i], self.uid[i], self.rid[i], self.rank[i], self.response(i),
+                         self.score[i], self.skew[i])
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._views = []
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
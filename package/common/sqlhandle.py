@@ -1,24 +1,57 @@
+import cProfile
 import logging
 import sqlite3
-from collections import namedtuple
-from queue import Queue
+from collections import namedtuple, deque
+from enum import Enum
 from threading import Thread, Event, Condition, get_ident, Lock, RLock
-from time import time_ns
-from typing import Union, List, Tuple, Dict
+from time import time_ns, perf_counter, monotonic
+from typing import Union, List, Tuple, Dict, Deque, Optional
 
+from .columns import ColumnSet
 from .rwlock import RWLock, lock_read, lock_write
 
 sql_thread_logger = logging.getLogger("sqlitethread")
 
+PRIORITY_HIGH = 0
+"""Priority for schema and other administrative operations."""
+PRIORITY_NORMAL = 1
+"""Default priority of a request."""
+PRIORITY_LOW = 2
+"""Priority for requests that may be shed under load, such as status lookups."""
+STATEMENT_CACHE_SIZE = 512
+"""Default number of compiled statements the connection keeps, enough for every registered query."""
+
 
 class SQLThreadShuttingDownError(Exception):
     pass
 
 
+class SQLThreadOverloadedError(Exception):
+    pass
+
+
+class SQLRequestTimeoutError(Exception):
+    pass
+
+
+class SQLRequestCancelledError(Exception):
+    pass
+
+
+class OverloadPolicy(Enum):
+    """What to do with a request when the queue of pending operations is full."""
+    BLOCK = "block"
+    """Wait for space in the queue, up to the request timeout."""
+    REJECT = "reject"
+    """Fail the request immediately."""
+    SHED = "shed"
+    """Drop the lowest priority pending operation to make space, or reject if none is lower than the request."""
+
+
 class CleanupTimer(Thread):
     """A Timer that handles cleaning up the results dictionary regularly."""
     def __init__(self, thread, time):
-        Thread.__init__(self)
+        Thread.__init__(self, daemon=True)
         self.stopped = Event()
         self.sqlthread = thread
         self.cleantime = time
@@ -31,12 +64,100 @@ class CleanupTimer(Thread):
             sql_thread_logger.debug("Finished collecting garbage")
 
 
+class RequestQueue:
+    """A bounded queue of pending operations, served by priority and then in order of arrival."""
+    _pending: List[Deque[Tuple[int, Union[Tuple[str, Tuple], List[Tuple[str, Tuple]]]]]]
+    _index: Dict[int, Tuple[int, tuple]]
+    maxsize: int
+    policy: OverloadPolicy
+    closed: bool
+
+    def __init__(self, maxsize: int = 0, policy: OverloadPolicy = OverloadPolicy.BLOCK):
+        self._pending = [deque() for _ in range(PRIORITY_LOW + 1)]
+        self._index = dict()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.closed = False
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+        self.not_full = Condition(self.mutex)
+
+    def __len__(self):
+        return len(self._index)
+
+    def _full(self) -> bool:
+        return 0 < self.maxsize <= len(self._index)
+
+    def _remove(self, oid: int) -> bool:
+        if oid not in self._index:
+            return False
+        priority, item = self._index.pop(oid)
+        self._pending[priority].remove(item)
+        self.not_full.notify()
+        return True
+
+    def put(self, oid: int, query, priority: int = PRIORITY_NORMAL, timeout: float = None) -> Optional[int]:
+        """Enqueues an operation. Returns the oid of an operation that was shed to make space, if any.
+
+        Raises SQLThreadOverloadedError if the operation could not be enqueued under the overload policy,
+        and SQLThreadShuttingDownError if the queue has been closed."""
+        with self.mutex:
+            if self.closed:
+                raise SQLThreadShuttingDownError("Thread is shutting down")
+            shed = None
+            if self._full():
+                if self.policy is OverloadPolicy.BLOCK:
+                    if not self.not_full.wait_for(lambda: self.closed or not self._full(), timeout):
+                        raise SQLThreadOverloadedError("Timed out waiting for space in the queue")
+                    if self.closed:
+                        raise SQLThreadShuttingDownError("Thread is shutting down")
+                elif self.policy is OverloadPolicy.SHED and any(self._pending[priority + 1:]):
+                    # shed the most recent of the lowest priority operations, since it has waited the least
+                    shed = next(q for q in reversed(self._pending) if q)[-1][0]
+                    self._remove(shed)
+                else:
+                    raise SQLThreadOverloadedError("Queue is full with {:d} pending operations".format(len(self)))
+            item = (oid, query)
+            self._pending[priority].append(item)
+            self._index[oid] = (priority, item)
+            self.not_empty.notify()
+            return shed
+
+    def get(self, drain: bool = True):
+        """Takes the next operation, blocking until one is available.
+        Returns None once the queue is closed, and either empty or not being drained."""
+        with self.mutex:
+            self.not_empty.wait_for(lambda: self.closed or self._index)
+            if self.closed and not (drain and self._index):
+                return None
+            oid, query = next(q for q in self._pending if q).popleft()
+            del self._index[oid]
+            self.not_full.notify()
+            return oid, query
+
+    def cancel(self, oid: int) -> bool:
+        """Removes an operation that has not yet started. Returns whether it was removed."""
+        with self.mutex:
+            return self._remove(oid)
+
+    def close(self) -> List[int]:
+        """Stops accepting operations and wakes up every waiting thread. Returns the oids still pending."""
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+            return list(self._index)
+
+
 Result = namedtuple("Result", ["res", "time"])
+NamedQuery = namedtuple("NamedQuery", ["name", "statement", "params", "columnar"])
+"""A request for a registered query, whose running time is collected under its name."""
+QueryTiming = namedtuple("QueryTiming", ["name", "count", "total", "max"])
 
 class SQLThread(Thread):
     """A thread that handles all SQL operations, including reads and writes."""
     _results: Dict[int, Union[Condition, namedtuple]]
-    _ops: Queue
+    _ops: RequestQueue
     sql_resource: Lock
     shutdown: Event
     _opcount: int
@@ -45,11 +166,24 @@ class SQLThread(Thread):
     cleanup: CleanupTimer
     db: str
     atomic: RLock
+    timeout: float
+    drain: bool
+    profiler: Optional[cProfile.Profile]
+    cached_statements: int
+    _timings: Dict[str, List[float]]
+    _deadlines: Dict[int, Tuple[float, float]]
 
-    def __init__(self, db: str = ":memory:", cleantime: int = 1200):
+    def __init__(self, db: str = ":memory:", cleantime: int = 1200, maxsize: int = 1024,
+                 policy: OverloadPolicy = OverloadPolicy.BLOCK, timeout: float = 30,
+                 cached_statements: int = STATEMENT_CACHE_SIZE):
+        """Constructs a SQLThread on database file db.
+
+        maxsize bounds the number of pending operations (0 for unbounded), policy decides what happens to requests
+        once that bound is reached, and timeout is the default number of seconds a caller waits for its result.
+        cached_statements is the size of the connection's cache of compiled statements."""
         Thread.__init__(self)
         self._results = dict()
-        self._ops = Queue()
+        self._ops = RequestQueue(maxsize, policy)
         self.shutdown = Event()
         self._opcount = 0
         self.rwlock = RWLock()
@@ -57,73 +191,216 @@ class SQLThread(Thread):
         self.db = db
         self.sql_resource = Lock()
         self.atomic = RLock()
+        self.timeout = timeout
+        self.drain = True
+        self.profiler = None
+        """If set, the worker profiles the operations it runs with it."""
+        self.cached_statements = cached_statements
+        self._timings = dict()
+        self._deadlines = dict()
 
     def run(self):
         self.shutdown.clear()
         self._cthread.start()
-        self.conn = sqlite3.Connection(self.db)
-        while not self.shutdown.is_set():
-            oid, ops = self._ops.get()
+        self.conn = sqlite3.Connection(self.db, cached_statements=self.cached_statements)
+        while True:
+            op = self._ops.get(self.drain)
+            if op is None:
+                break
+            oid, ops = op
             sql_thread_logger.debug("Handling oid {:d}".format(oid))
             self.sql_resource.acquire()
-            cursor = self.conn.cursor()
+            profiler = self.profiler
             try:
+                if profiler is not None:
+                    try:
+                        profiler.enable()
+                    except Exception as e:
+                        # such as another profiler already being active, which must not stop the worker
+                        sql_thread_logger.warning("Could not profile the SQL thread: {}".format(e))
+                        profiler = None
+                cursor = self.conn.cursor()
                 if isinstance(ops, list):
                     for statement, params in ops:
                         cursor.execute(statement, params)
+                    res = cursor.fetchall()
+                elif isinstance(ops, NamedQuery):
+                    start = perf_counter()
+                    cursor.execute(ops.statement, ops.params)
+                    res = ColumnSet.from_cursor(cursor) if ops.columnar else cursor.fetchall()
+                    self._time(ops.name, perf_counter() - start)
                 else:
                     statement, params = ops
                     cursor.execute(statement, params)
-                res = cursor.fetchall()
-            except sqlite3.Error as e:
+                    res = cursor.fetchall()
+                self.conn.commit()
+            except Exception as e:
+                # any failure, including bad parameters or a failed commit, fails only this operation
                 res = e
-            self.conn.commit()
-            self.sql_resource.release()
-            with lock_read(self.rwlock):
-                cond = self._results[oid]
-            with lock_write(self.rwlock):
-                self._results[oid] = Result(res=res, time=time_ns())
+                try:
+                    self.conn.rollback()
+                except sqlite3.Error as rollback_error:
+                    sql_thread_logger.error("Failed to roll back oid {:d}: {}".format(oid, rollback_error))
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                self.sql_resource.release()
             sql_thread_logger.debug("Finished processing, now notifying")
-            cond.acquire()
-            sql_thread_logger.debug("Acquired, notifying")
-            cond.notify_all()
-            cond.release()
-        with lock_write(self.rwlock):
-            while not self._ops.empty():
-                oid = self._ops.get()[0]
-                cond = self._results[oid]
-                self._results[oid] = Result(res=SQLThreadShuttingDownError("Thread is shutting down"), time=time_ns())
-                cond.acquire()
-                cond.notify_all()
+            self._finish(oid, res)
+        for oid in self._ops.close():
+            self._finish(oid, SQLThreadShuttingDownError("Thread is shutting down"))
+        self.conn.close()
         self._cthread.stopped.set()
+        sql_thread_logger.debug("Thread {} has shut down".format(get_ident()))
 
-    def close(self):
+    def _finish(self, oid: int, res):
+        """Stores the result of an operation and notifies its caller. Results nobody is waiting for are dropped."""
+        with lock_write(self.rwlock):
+            cond = self._results.get(oid)
+            if not isinstance(cond, Condition):
+                return
+            self._results[oid] = Result(res=res, time=time_ns())
+        with cond:
+            cond.notify_all()
+
+    def close(self, drain: bool = True, timeout: float = None):
+        """Stops accepting requests and shuts the thread down.
+
+        If drain is set, operations already queued are still run, otherwise they fail with
+        SQLThreadShuttingDownError. If timeout is given, waits at most that long for the thread to finish."""
+        self.drain = drain
         self._cthread.stopped.set()
         self.shutdown.set()
+        self._ops.close()
+        if timeout is not None and self.is_alive():
+            self.join(timeout)
 
-    def request(self, query: Union[Tuple[str, Tuple], List[Tuple[str, Tuple]]], cond: Condition) -> int:
+    def request(self, query: Union[Tuple[str, Tuple], List[Tuple[str, Tuple]]], cond: Condition,
+                priority: int = PRIORITY_NORMAL, timeout: float = None) -> int:
         """Makes a request, with a condition flag that should be used to
         check when the request has finished.
 
+        If query is a NamedQuery, its running time is collected under its name, see query_timings,
+        and its result is a ColumnSet instead of a list of rows if it is columnar.
+
+        The request has one deadline, timeout seconds (the thread's default if None) from now, covering the wait
+        for space in the queue under the BLOCK policy and the wait for its result in wait_result.
+        Raises SQLThreadOverloadedError if the request could not be queued before the deadline.
+        Raises SQLThreadShuttingDownError if the thread is not running. A request that fails for any reason is
+        rolled back, and the exception is its result.
+
         Precondition: cond must be acquired by the calling thread.
         cond must be waited on or released after this function call."""
         if self.shutdown.is_set(): raise SQLThreadShuttingDownError("Thread is shutting down")
+        if not self.is_alive(): raise SQLThreadShuttingDownError("Thread is not running")
         sql_thread_logger.debug("Request from thread {}".format(get_ident()))
-        self.atomic.acquire()
-        with lock_write(self.rwlock):
-            oid = self._opcount
-            self._ops.put((oid, query))
-            self._results[oid] = cond
-            self._opcount += 1
-        self.atomic.release()
+        if timeout is None:
+            timeout = self.timeout
+        start = monotonic()
+        # atomic is only taken to wait out atomic sections of other threads, never held while queueing
+        if not self.atomic.acquire(timeout=timeout):
+            raise SQLThreadOverloadedError("Timed out waiting for an atomic section to finish")
+        try:
+            with lock_write(self.rwlock):
+                oid = self._opcount
+                self._opcount += 1
+                self._results[oid] = cond
+                self._deadlines[oid] = (start, start + timeout)
+        finally:
+            self.atomic.release()
+        try:
+            shed = self._ops.put(oid, query, priority, max(start + timeout - monotonic(), 0))
+        except Exception:
+            with lock_write(self.rwlock):
+                del self._results[oid]
+                del self._deadlines[oid]
+            raise
+        if shed is not None:
+            sql_thread_logger.warning("Queue is full, shed oid {:d}".format(shed))
+            self._finish(shed, SQLThreadOverloadedError("Request was shed to make space for a higher priority one"))
         return oid
 
+    def execute(self, query: Union[Tuple[str, Tuple], List[Tuple[str, Tuple]]], priority: int = PRIORITY_NORMAL,
+                timeout: float = None):
+        """Makes a request and waits for its result, taking care of its condition. See request.
+
+        The error a request failed with is returned as its result, while errors making or waiting for it,
+        such as SQLRequestTimeoutError, are raised."""
+        cond = Condition()
+        cond.acquire()
+        try:
+            oid = self.request(query, cond, priority, timeout)
+        except Exception:
+            cond.release()
+            raise
+        return self.wait_result(oid, cond)
+
+    def wait_result(self, oid: int, cond: Condition, timeout: float = None):
+        """Waits for and consumes the result of an OID, then releases cond.
+
+        Raises SQLRequestTimeoutError if no result arrives by the request's deadline or, if timeout is given,
+        within timeout seconds of the request being made.
+        A timed out request is cancelled if it has not started; if it has, its result is discarded.
+
+        Precondition: cond must be the acquired condition passed to request."""
+        try:
+            with lock_write(self.rwlock):
+                start, deadline = self._deadlines.pop(oid, (monotonic(), None))
+            if timeout is not None:
+                deadline = start + timeout
+            elif deadline is None:
+                deadline = start + self.timeout
+            if not cond.wait_for(lambda: self._finished(oid), max(deadline - monotonic(), 0)):
+                started = not self.cancel(oid)
+                raise SQLRequestTimeoutError("Request {:d} timed out after {:g}s{}".format(
+                    oid, deadline - start, " while running" if started else ""))
+            with lock_write(self.rwlock):
+                return self._results.pop(oid).res
+        finally:
+            cond.release()
+
+    def _finished(self, oid: int) -> bool:
+        with lock_read(self.rwlock):
+            return isinstance(self._results.get(oid), Result)
+
+    def cancel(self, oid: int) -> bool:
+        """Cancels a request. Returns True if it was removed before it started running,
+        in which case its caller receives SQLRequestCancelledError as the result.
+        Otherwise the result of the request, once available, is discarded."""
+        if self._ops.cancel(oid):
+            self._finish(oid, SQLRequestCancelledError("Request {:d} was cancelled".format(oid)))
+            return True
+        with lock_write(self.rwlock):
+            self._results.pop(oid, None)
+        return False
+
+    def _time(self, name: str, elapsed: float):
+        timing = self._timings.get(name)
+        if timing is None:
+            self._timings[name] = [1, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+
+    def query_timings(self, reset: bool = False) -> List[QueryTiming]:
+        """Running times of each named query so far, slowest in total first. If reset is set, starts over."""
+        with self.sql_resource:
+            timings = [QueryTiming(name, *timing) for name, timing in self._timings.items()]
+            if reset:
+                self._timings = dict()
+        return sorted(timings, key=lambda t: -t.total)
+
+    def queue_depth(self) -> int:
+        """Number of operations waiting to run."""
+        return len(self._ops)
+
     def get_result(self, oid: int):
         """Obtain result for an OID if it is available.
         If your condition is not notified, then there is no guarantee
         this method will not return None."""
         with lock_read(self.rwlock):
-            if isinstance(self._results[oid], Result):
+            if isinstance(self._results.get(oid), Result):
                 return self._results[oid].res
         return
 
@@ -132,7 +409,9 @@ class SQLThread(Thread):
         curtime = time_ns()
         sql_thread_logger.debug("Thread {} is cleaning up".format(get_ident()))
         with lock_write(self.rwlock):
-            for k, v in self._results.items():
-                if isinstance(v, Result) and v.time - curtime > self._cthread.cleantime * 1000000000:
-                    # if 100 seconds elapsed and did not read result, delete
-                    del self._results[k]
\ No newline at end of file
+            for k, v in list(self._results.items()):
+                if isinstance(v, Result) and curtime - v.time > self._cthread.cleantime * 1000000000:
+                    # if cleantime elapsed and did not read result, delete
+                    del self._results[k]
+            for k in [k for k in self._deadlines if k not in self._results]:
+                del self._deadlines[k]
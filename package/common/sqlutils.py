@@ -1,12 +1,16 @@
 import logging
 import sqlite3
 from threading import Condition, get_ident
-from typing import Callable, Tuple
+from typing import Callable, Tuple, List, Dict, Iterable
+from array import array
 from collections import namedtuple
 from time import time_ns
 
 from package.common.rwlock import lock_read
-from .sqlhandle import SQLThread
+from .columns import ColumnSet
+from .queries import register_query, run_query
+from .similarity import index_statements, similarity
+from .sqlhandle import SQLThread, PRIORITY_HIGH, PRIORITY_LOW
 
 sql_thread_logger = logging.getLogger("sqlitethread")
 Status = namedtuple("Status", ["id", "round_num", "prompt", "phase", "deadline", "start_time"])
@@ -15,17 +19,26 @@ Response = namedtuple("Response", ["id", "uid", "rid", "response", "word_count",
 Member = namedtuple("Member", ["uid", "vid", "total_votes", "round_votes", "timezone", "remind_in", "remind_every"])
 Vote = namedtuple("Vote", ["id", "vid", "vote_num", "seed", "vote"])
 Result = namedtuple("Result", ["round_num", "id", "uid", "rid", "rank", "response", "score", "skew"])
+LOOKUP_CHUNK = 500
+"""Number of keys looked up by each query of a bulk lookup, below SQLite's limit on parameters."""
+_KEYS = "(" + ", ".join("?" * LOOKUP_CHUNK) + ")"
+Duplicate = namedtuple("Duplicate", ["id", "uid", "response", "other_id", "other_uid", "other_round",
+                                     "other_response", "similarity"])
 
 
 def sql_get(ret_tuple=None):
-    """Decorator method that casts SQL rows to a named tuple, or leaves them as is if no arg given"""
+    """Decorator method that casts SQL rows to a named tuple, or leaves them as is if no arg given.
+    The decorated function takes an optional timeout keyword, in seconds."""
     def deco(func: Callable):
-        def nfunc(thread: SQLThread, *args, **kwargs):
+        def nfunc(thread: SQLThread, *args, timeout: float = None, **kwargs):
             cond = Condition()
             cond.acquire()
-            oid = func(thread, cond, *args, **kwargs)
-            cond.wait()
-            res = thread.get_result(oid)
+            try:
+                oid = func(thread, cond, *args, **kwargs)
+            except Exception:
+                cond.release()
+                raise
+            res = thread.wait_result(oid, cond, timeout)
             if ret_tuple is not None:
                 return map(ret_tuple._make, res)
             return res
@@ -33,15 +46,19 @@ def sql_get(ret_tuple=None):
     return deco
 
 def sql_run(handler: Callable = None, *params, **kwparams):
-    """Decorator method that allows for error handling"""
+    """Decorator method that allows for error handling.
+    The decorated function takes an optional timeout keyword, in seconds."""
     def deco(func: Callable):
-        def nfunc(thread: SQLThread, *args, **kwargs):
+        def nfunc(thread: SQLThread, *args, timeout: float = None, **kwargs):
             cond = Condition()
             cond.acquire()
-            oid = func(thread, cond, *args, **kwargs)
-            cond.wait()
-            res = thread.get_result(oid)
-            if isinstance(res, sqlite3.Error):
+            try:
+                oid = func(thread, cond, *args, **kwargs)
+            except Exception:
+                cond.release()
+                raise
+            res = thread.wait_result(oid, cond, timeout)
+            if isinstance(res, Exception):
                 if handler is not None:
                     handler(res, *params, **kwparams)
                     return None
@@ -90,6 +107,7 @@ def construct_schema(thread: SQLThread, condition: Condition):
             gseed TEXT UNIQUE NOT NULL,
             vote TEXT
         );""", ()),
+        ("CREATE INDEX IF NOT EXISTS VotesVid ON Votes (vid);", ()),
         ("""CREATE TABLE IF NOT EXISTS Status (
             id INTEGER PRIMARY KEY,
             roundNum INTEGER,
@@ -108,8 +126,41 @@ def construct_schema(thread: SQLThread, condition: Condition):
             response TEXT NOT NULL,
             score DOUBLE NOT NULL,
             skew DOUBLE NOT NULL
-        );""", ())
-    ], condition)
+        );""", ()),
+        ("""CREATE TABLE IF NOT EXISTS ResponseSignatures (
+            id INTEGER PRIMARY KEY NOT NULL,
+            signature BLOB NOT NULL
+        );""", ()),
+        ("""CREATE TABLE IF NOT EXISTS ResponseBands (
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            id INTEGER NOT NULL
+        );""", ()),
+        ("CREATE INDEX IF NOT EXISTS ResponseBandsBucket ON ResponseBands (band, bucket);", ()),
+        ("CREATE INDEX IF NOT EXISTS ResponseBandsId ON ResponseBands (id);", ()),
+        ("CREATE INDEX IF NOT EXISTS ResponseArchiveId ON ResponseArchive (id);", ()),
+        ("""CREATE VIRTUAL TABLE IF NOT EXISTS ResponseArchiveSearch USING fts5(
+            response,
+            content='ResponseArchive',
+            content_rowid='rowid'
+        );""", ()),
+        ("""CREATE TRIGGER IF NOT EXISTS ResponseArchiveSearchInsert AFTER INSERT ON ResponseArchive BEGIN
+            INSERT INTO ResponseArchiveSearch(rowid, response) VALUES (new.rowid, new.response);
+        END;""", ()),
+        ("""CREATE TRIGGER IF NOT EXISTS ResponseArchiveSearchDelete AFTER DELETE ON ResponseArchive BEGIN
+            INSERT INTO ResponseArchiveSearch(ResponseArchiveSearch, rowid, response)
+                VALUES ('delete', old.rowid, old.response);
+        END;""", ()),
+        ("""CREATE TRIGGER IF NOT EXISTS ResponseArchiveSearchUpdate AFTER UPDATE OF response ON ResponseArchive BEGIN
+            INSERT INTO ResponseArchiveSearch(ResponseArchiveSearch, rowid, response)
+                VALUES ('delete', old.rowid, old.response);
+            INSERT INTO ResponseArchiveSearch(rowid, response) VALUES (new.rowid, new.response);
+        END;""", ()),
+        # index an archive that predates the search table
+        ("""INSERT INTO ResponseArchiveSearch(ResponseArchiveSearch) SELECT 'rebuild'
+            WHERE NOT EXISTS (SELECT 1 FROM ResponseArchiveSearch_docsize)
+            AND EXISTS (SELECT 1 FROM ResponseArchive);""", ())
+    ], condition, PRIORITY_HIGH)
 
 
 @sql_get()
@@ -121,8 +172,11 @@ def destroy_schema(thread: SQLThread, condition: Condition):
         ("DROP TABLE Responses;", ()),
         ("DROP TABLE Votes;", ()),
         ("DROP TABLE Status;", ()),
-        ("DROP TABLE ResponseArchive;", ())
-    ], condition)
+        ("DROP TABLE ResponseArchiveSearch;", ()),
+        ("DROP TABLE ResponseArchive;", ()),
+        ("DROP TABLE ResponseSignatures;", ()),
+        ("DROP TABLE ResponseBands;", ())
+    ], condition, PRIORITY_HIGH)
 
 
 @sql_get()
@@ -142,73 +196,184 @@ def snapshot_schema(thread: SQLThread, filename: str):
     backup.close()
 
 
-@sql_get(Status)
-def get_status(thread: SQLThread, condition: Condition):
+register_query("get_status", "SELECT * FROM Status;", Status, ["Status"], priority=PRIORITY_LOW)
+register_query("get_contestant", "SELECT * FROM Contestants WHERE uid = ?;", Contestant, ["Contestants"])
+register_query("get_voter_by_uid", "SELECT * FROM Members WHERE uid = ?;", Member, ["Members"])
+register_query("get_voter_by_vid", "SELECT * FROM Members WHERE vid = ?;", Member, ["Members"])
+register_query("get_vote", "SELECT * FROM Votes WHERE vid = ? AND vnum = ?;", Vote, ["Votes"])
+register_query("get_response", "SELECT * FROM Responses WHERE uid = ? AND rid = ?;", Response, ["Responses"])
+register_query("get_vids", "SELECT vid FROM Members WHERE vid NOT NULL;", tables=["Members"])
+register_query("get_responses", "SELECT * FROM Responses WHERE uid = ?;", Response, ["Responses"])
+register_query("get_votes", "SELECT * FROM Votes WHERE vid = ?;", Vote, ["Votes"])
+register_query("get_votes_columns", "SELECT * FROM Votes;", Vote, ["Votes"], columnar=True)
+register_query("get_round_responses_columns", "SELECT * FROM Responses ORDER BY id;", Response, ["Responses"],
+               columnar=True)
+register_query("get_round_archive_columns", "SELECT * FROM ResponseArchive WHERE roundNum = ?;", Result,
+               ["ResponseArchive"], columnar=True)
+register_query("get_archive_columns", "SELECT * FROM ResponseArchive;", Result, ["ResponseArchive"], columnar=True)
+register_query("get_archive_since_columns", "SELECT * FROM ResponseArchive WHERE roundNum > ? ORDER BY roundNum, rank;",
+               Result, ["ResponseArchive"], columnar=True)
+register_query("fingerprint_archive_through", """SELECT count(*), total(score), total(rank), max(rowid)
+    FROM ResponseArchive WHERE roundNum <= ?;""", tables=["ResponseArchive"])
+register_query("search_archive", """SELECT a.* FROM ResponseArchiveSearch s JOIN ResponseArchive a ON a.rowid = s.rowid
+    WHERE ResponseArchiveSearch MATCH ? AND (? IS NULL OR a.uid = ?) AND (? IS NULL OR a.roundNum = ?)
+    ORDER BY s.rank LIMIT ? OFFSET ?;""", Result, ["ResponseArchiveSearch", "ResponseArchive"])
+register_query("uid2vid", "SELECT vid FROM Members WHERE uid = ?;", tables=["Members"])
+register_query("vid2uid", "SELECT uid FROM Members WHERE vid = ?;", tables=["Members"])
+register_query("uid2vid_many", "SELECT uid, vid FROM Members WHERE uid IN " + _KEYS + ";", tables=["Members"])
+register_query("vid2uid_many", "SELECT vid, uid FROM Members WHERE vid IN " + _KEYS + ";", tables=["Members"])
+register_query("get_contestants", "SELECT * FROM Contestants WHERE uid IN " + _KEYS + ";", Contestant,
+               ["Contestants"])
+register_query("get_voters_by_uid", "SELECT * FROM Members WHERE uid IN " + _KEYS + ";", Member, ["Members"])
+register_query("get_voters_by_vid", "SELECT * FROM Members WHERE vid IN " + _KEYS + ";", Member, ["Members"])
+register_query("set_phase", "UPDATE Status SET phase = ?;", tables=["Status"])
+register_query("set_time", "UPDATE Status SET startTime = ?, deadline = ?;", tables=["Status"])
+register_query("get_deadline", "SELECT startTime, deadline FROM Status;", tables=["Status"])
+register_query("unindexed_responses", """SELECT id, response FROM Responses
+    WHERE id NOT IN (SELECT id FROM ResponseSignatures)
+    UNION SELECT id, response FROM ResponseArchive WHERE id NOT IN (SELECT id FROM ResponseSignatures)
+    LIMIT ?;""", tables=["Responses", "ResponseArchive", "ResponseSignatures"], priority=PRIORITY_LOW)
+# bands of deleted responses are left in the index, so the other response of a pair must still exist
+register_query("duplicate_candidates", """SELECT DISTINCT a.id, b.id FROM Responses r
+    JOIN ResponseBands a ON a.id = r.id
+    JOIN ResponseBands b ON b.band = a.band AND b.bucket = a.bucket AND b.id != a.id
+    WHERE EXISTS (SELECT 1 FROM Responses WHERE id = b.id) OR EXISTS (SELECT 1 FROM ResponseArchive WHERE id = b.id);""",
+               tables=["Responses", "ResponseBands", "ResponseArchive"])
+
+
+def get_status(thread: SQLThread, *, timeout: float = None):
     sql_thread_logger.debug("Thread {} requesting mTWOW status".format(get_ident()))
-    return thread.request(("SELECT * FROM Status", ()), condition)
+    return run_query(thread, "get_status", timeout=timeout)
 
 
-@sql_get(Contestant)
-def get_contestant(thread: SQLThread, condition: Condition, uid: int):
+def get_contestant(thread: SQLThread, uid: int, *, timeout: float = None):
     sql_thread_logger.debug("Thread {} requesting Contestant {}'s data".format(get_ident(), uid))
-    return thread.request(("SELECT * FROM Contestants WHERE uid = ?;", (uid,)), condition)
+    return run_query(thread, "get_contestant", (uid,), timeout=timeout)
 
 
-@sql_get(Member)
-def get_voter(thread: SQLThread, condition: Condition, *, uid: int, vid: int):
+def get_voter(thread: SQLThread, *, uid: int = None, vid: int = None, timeout: float = None):
     if uid is not None:
         sql_thread_logger.debug("Thread {} requesting Member with UID {}'s data".format(get_ident(), uid))
-        return thread.request(("SELECT * FROM Members WHERE uid = ?;", (uid, )), condition)
+        return run_query(thread, "get_voter_by_uid", (uid,), timeout=timeout)
     elif vid is not None:
-        sql_thread_logger.debug("Thread {} requesting Member with VID {}'s data".format(get_ident(), uid))
-        return thread.request(("SELECT * FROM Members WHERE vid = ?;", (vid, )), condition)
+        sql_thread_logger.debug("Thread {} requesting Member with VID {}'s data".format(get_ident(), vid))
+        return run_query(thread, "get_voter_by_vid", (vid,), timeout=timeout)
     raise sqlite3.Error("No arguments provided to voter get function")
 
 
-@sql_get(Vote)
-def get_vote(thread: SQLThread, condition: Condition, vid: int, votenum: int):
+def get_vote(thread: SQLThread, vid: int, votenum: int, *, timeout: float = None):
     sql_thread_logger.debug("Thread {} requesting vote {} of the user with VID {}".format(get_ident(), votenum, vid))
-    return thread.request(("SELECT * FROM Votes WHERE vid = ? AND vnum = ?;", (vid, votenum)), condition)
+    return run_query(thread, "get_vote", (vid, votenum), timeout=timeout)
 
 
-@sql_get(Response)
-def get_response(thread: SQLThread, condition: Condition, uid: int, rid: int):
-    sql_thread_logger.debug("Thread {} requesting response {} of the user with VID {}".format(get_ident(), rid, uid))
-    return thread.request(("SELECT * FROM Votes WHERE uid = ? AND rid = ?;", (uid, rid)), condition)
+def get_response(thread: SQLThread, uid: int, rid: int, *, timeout: float = None):
+    sql_thread_logger.debug("Thread {} requesting response {} of the user with UID {}".format(get_ident(), rid, uid))
+    return run_query(thread, "get_response", (uid, rid), timeout=timeout)
 
 
-@sql_get()
-def get_vids(thread: SQLThread, condition: Condition):
+def get_vids(thread: SQLThread, *, timeout: float = None):
     sql_thread_logger.debug("Thread {} requesting list of VIDs".format(get_ident()))
-    return thread.request(("SELECT vid FROM Members WHERE vid NOT NULL;", ()), condition)
+    return run_query(thread, "get_vids", timeout=timeout)
 
 
-@sql_get(Response)
-def get_responses(thread: SQLThread, condition: Condition, uid: int):
+def get_responses(thread: SQLThread, uid: int, *, timeout: float = None):
     sql_thread_logger.debug("Thread {} requesting list of responses from UID {}".format(get_ident(), uid))
-    return thread.request(("SELECT * FROM Responses WHERE uid = ?;", (uid,)), condition)
+    return run_query(thread, "get_responses", (uid,), timeout=timeout)
 
 
-@sql_get(Vote)
-def get_votes(thread: SQLThread, condition: Condition, vid: int):
+def get_votes(thread: SQLThread, vid: int, *, timeout: float = None):
     sql_thread_logger.debug("Thread {} requesting list of votes from VID {}".format(get_ident(), vid))
-    return thread.request(("SELECT * FROM Votes WHERE vid = ?;", (vid,)), condition)
+    return run_query(thread, "get_votes", (vid,), timeout=timeout)
+
+
+def get_votes_columns(thread: SQLThread, *, timeout: float = None) -> ColumnSet:
+    sql_thread_logger.debug("Thread {} requesting all votes as columns".format(get_ident()))
+    return run_query(thread, "get_votes_columns", timeout=timeout)
+
+
+def get_round_responses_columns(thread: SQLThread, *, timeout: float = None) -> ColumnSet:
+    sql_thread_logger.debug("Thread {} requesting all responses as columns".format(get_ident()))
+    return run_query(thread, "get_round_responses_columns", timeout=timeout)
+
+
+def get_archive_columns(thread: SQLThread, round_num: int = None, *, timeout: float = None) -> ColumnSet:
+    if round_num is not None:
+        sql_thread_logger.debug("Thread {} requesting archive of round {} as columns".format(get_ident(), round_num))
+        return run_query(thread, "get_round_archive_columns", (round_num,), timeout=timeout)
+    sql_thread_logger.debug("Thread {} requesting the full archive as columns".format(get_ident()))
+    return run_query(thread, "get_archive_columns", timeout=timeout)
+
+
+def get_archive_since_columns(thread: SQLThread, round_num: int, *, timeout: float = None) -> ColumnSet:
+    """Archived responses of the rounds after round_num as columns, by round and then by rank."""
+    sql_thread_logger.debug("Thread {} requesting archive after round {} as columns".format(get_ident(), round_num))
+    return run_query(thread, "get_archive_since_columns", (round_num,), timeout=timeout)
+
+
+def fingerprint_archive_through(thread: SQLThread, round_num: int, *, timeout: float = None) -> list:
+    """The number of archived responses of round round_num and the rounds before it, the totals of their scores
+    and ranks, and their largest rowid, which change whenever any of those rows are added, removed or rescored."""
+    return list(run_query(thread, "fingerprint_archive_through", (round_num,), timeout=timeout)[0])
+
+
+def _match_phrase(query: str) -> str:
+    """Quotes each word of a user's query, so that FTS5 syntax in it is searched for literally."""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def search_archive(thread: SQLThread, query: str, uid: int = None, round_num: int = None, page: int = 1,
+                   per_page: int = 10, *, timeout: float = None):
+    """Full-text search of archived responses containing every word of query, best matches first."""
+    sql_thread_logger.debug("Thread {} is searching the archive for '{}'".format(get_ident(), query))
+    return run_query(thread, "search_archive", (_match_phrase(query), uid, uid, round_num, round_num, per_page,
+                                                (page - 1) * per_page), timeout=timeout)
 
 
 def uid2vid(thread: SQLThread, uid: int):
-    cond = Condition()
-    cond.acquire()
-    oid = thread.request(("SELECT vid FROM Members WHERE uid = ?;", (uid,)), cond)
-    cond.wait()
-    return thread.get_result(oid)[0][0]
+    return run_query(thread, "uid2vid", (uid,))[0][0]
 
 
 def vid2uid(thread: SQLThread, vid: int):
-    cond = Condition()
-    cond.acquire()
-    oid = thread.request(("SELECT uid FROM Members WHERE vid = ?;", (vid,)), cond)
-    cond.wait()
-    return thread.get_result(oid)[0][0]
+    return run_query(thread, "vid2uid", (vid,))[0][0]
+
+
+def _lookup(thread: SQLThread, name: str, keys: Iterable[int], timeout: float = None):
+    """Runs a bulk lookup query on every distinct key, LOOKUP_CHUNK keys at a time, and chains the results.
+    The last chunk is padded with NULLs, which match nothing, so every chunk runs the same cached statement."""
+    keys = list(dict.fromkeys(keys))
+    for i in range(0, len(keys), LOOKUP_CHUNK):
+        chunk = tuple(keys[i:i + LOOKUP_CHUNK])
+        yield from run_query(thread, name, chunk + (None,) * (LOOKUP_CHUNK - len(chunk)), timeout=timeout)
+
+
+def uid2vid_many(thread: SQLThread, uids: Iterable[int], *, timeout: float = None) -> Dict[int, int]:
+    """VIDs of Members by UID. UIDs that are not Members are left out."""
+    sql_thread_logger.debug("Thread {} requesting VIDs of many UIDs".format(get_ident()))
+    return dict(_lookup(thread, "uid2vid_many", uids, timeout))
+
+
+def vid2uid_many(thread: SQLThread, vids: Iterable[int], *, timeout: float = None) -> Dict[int, int]:
+    """UIDs of Members by VID. Unknown VIDs are left out."""
+    sql_thread_logger.debug("Thread {} requesting UIDs of many VIDs".format(get_ident()))
+    return dict(_lookup(thread, "vid2uid_many", vids, timeout))
+
+
+def get_contestants(thread: SQLThread, uids: Iterable[int], *, timeout: float = None) -> Dict[int, Contestant]:
+    """Contestants by UID. UIDs that are not Contestants are left out."""
+    sql_thread_logger.debug("Thread {} requesting many Contestants' data".format(get_ident()))
+    return dict((contestant.uid, contestant) for contestant in _lookup(thread, "get_contestants", uids, timeout))
+
+
+def get_voters(thread: SQLThread, *, uids: Iterable[int] = None, vids: Iterable[int] = None,
+               timeout: float = None) -> Dict[int, Member]:
+    """Members by UID if uids are given, otherwise by VID. Unknown keys are left out."""
+    if uids is not None:
+        sql_thread_logger.debug("Thread {} requesting many Members' data by UID".format(get_ident()))
+        return dict((member.uid, member) for member in _lookup(thread, "get_voters_by_uid", uids, timeout))
+    elif vids is not None:
+        sql_thread_logger.debug("Thread {} requesting many Members' data by VID".format(get_ident()))
+        return dict((member.vid, member) for member in _lookup(thread, "get_voters_by_vid", vids, timeout))
+    raise sqlite3.Error("No arguments provided to voter get function")
 
 
 @sql_run()
@@ -218,19 +383,101 @@ def run(thread: SQLThread, condition: Condition, request: str, params: Tuple[str
 
 
 @sql_run()
-def set_time(thread: SQLThread, condition: Condition, start_time: int, time_left: int):
+def add_response(thread: SQLThread, condition: Condition, uid: int, rid: int, response: str):
+    """Adds a response to the current round and to the similarity index in one transaction."""
+    sql_thread_logger.debug("Thread {} is adding response {} of UID {}".format(get_ident(), rid, uid))
+    return thread.request([
+        ("INSERT INTO Responses (uid, rid, response, wordCount) VALUES (?, ?, ?, ?);",
+         (uid, rid, response, len(response.split())))
+    ] + index_statements(response), condition)
+
+
+def _unindexed(thread: SQLThread, limit: int):
+    return run_query(thread, "unindexed_responses", (limit,))
+
+
+@sql_run()
+def _index(thread: SQLThread, condition: Condition, rows: Iterable[Tuple[int, str]]):
+    statements = []
+    for rid, text in rows:
+        statements.append(("DELETE FROM ResponseBands WHERE id = ?;", (rid,)))
+        statements.extend(index_statements(text, rid))
+    return thread.request(statements, condition, PRIORITY_LOW)
+
+
+def index_responses(thread: SQLThread, batch: int = 1000) -> int:
+    """Adds every response in Responses and ResponseArchive that is missing from the similarity index,
+    batch responses per request. Returns the number of responses indexed."""
+    sql_thread_logger.debug("Thread {} is indexing responses".format(get_ident()))
+    count = 0
+    rows = _unindexed(thread, batch)
+    while rows:
+        _index(thread, rows)
+        count += len(rows)
+        rows = _unindexed(thread, batch)
+    sql_thread_logger.debug("Indexed {:d} responses".format(count))
+    return count
+
+
+@sql_get()
+def _signatures(thread: SQLThread, condition: Condition, ids: List[int]):
+    return thread.request(("SELECT id, signature FROM ResponseSignatures WHERE id IN ({});".format(
+        ", ".join("?" * len(ids))), tuple(ids)), condition)
+
+
+@sql_get()
+def _response_sources(thread: SQLThread, condition: Condition, ids: List[int]):
+    return thread.request(("""SELECT id, uid, NULL, response FROM Responses WHERE id IN ({0})
+        UNION ALL SELECT id, uid, roundNum, response FROM ResponseArchive WHERE id IN ({0});""".format(
+        ", ".join("?" * len(ids))), tuple(ids) * 2), condition)
+
+
+def find_duplicates(thread: SQLThread, threshold: float = 0.6) -> List[Duplicate]:
+    """Lists responses of the current round that look like copies of another response, current or archived,
+    by decreasing estimated similarity. Pairs within the current round are listed once,
+    and other_round is None when the other response is from the current round."""
+    sql_thread_logger.debug("Thread {} is looking for duplicate responses".format(get_ident()))
+    pairs = run_query(thread, "duplicate_candidates")
+    ids = list({i for pair in pairs for i in pair})
+    sigs: Dict[int, array] = dict()
+    for i in range(0, len(ids), 500):
+        for rid, blob in _signatures(thread, ids[i:i + 500]):
+            sigs[rid] = array("I")
+            sigs[rid].frombytes(blob)
+    current = {a for a, _ in pairs}
+    scored = []
+    for a, b in pairs:
+        if b in current and b < a or a not in sigs or b not in sigs:
+            continue
+        score = similarity(sigs[a], sigs[b])
+        if score >= threshold:
+            scored.append((score, a, b))
+    scored.sort(reverse=True)
+    found = list({i for _, a, b in scored for i in (a, b)})
+    info = dict()
+    for i in range(0, len(found), 400):
+        for rid, uid, round_num, text in _response_sources(thread, found[i:i + 400]):
+            info[rid] = (uid, round_num, text)
+    # a response deleted since the candidates were found is skipped
+    return [Duplicate(a, info[a][0], info[a][2], b, info[b][0], info[b][1], info[b][2], score)
+            for score, a, b in scored if a in info and b in info]
+
+
+def set_phase(thread: SQLThread, phase: str, *, timeout: float = None):
+    sql_thread_logger.debug("Thread {} is setting phase to {}".format(get_ident(), phase))
+    return run_query(thread, "set_phase", (phase,), timeout=timeout)
+
+
+def set_time(thread: SQLThread, start_time: int, time_left: int, *, timeout: float = None):
     sql_thread_logger.debug("Thread {} is setting startTime to {} and deadline to {}"
                             .format(get_ident(), start_time, time_left))
-    return thread.request(("UPDATE Status SET startTime = ?, deadline = ?;", (start_time, time_left)), condition)
+    return run_query(thread, "set_time", (start_time, time_left), timeout=timeout)
 
 
 def get_deadline(thread: SQLThread):
     sql_thread_logger.debug("Thread {} requesting the deadline.".format(get_ident()))
-    cond = Condition()
-    cond.acquire()
-    oid = thread.request(("SELECT startTime, deadline FROM Status;", ()), cond)
-    cond.wait()
-    return thread.get_result(oid)[0][0] + thread.get_result(oid)[0][1]
+    res = run_query(thread, "get_deadline")
+    return res[0][0] + res[0][1]
 
 
 def update_timers(thread: SQLThread):
@@ -3,9 +3,13 @@ import logging
 import sys
 from time import strftime, gmtime
 
-from package.common.sqlhandle import SQLThread
+from package.common.screens import ScreenCache
+from package.common.sqlhandle import SQLThread, OverloadPolicy
+from package.common.votes import VoteBuffer
 
 time_units = [24 * 60 * 60 * 1000, 60 * 60 * 1000, 60 * 1000, 1000, 1]
+UPLOAD_LIMIT = 8 * 1024 * 1024
+"""Largest file, in bytes, that will be attached to a message instead of only reported."""
 
 
 class InvalidTimeStringError(Exception):
@@ -114,6 +118,22 @@ def load_data(filename) -> dict:
     if data.get("prefix") is None:
         discord_logger.warning("No prefix. This bot will use the default prefix, 'p?'.")
         data["prefix"] = "p?"
+    if not isinstance(data.get("sqlQueueSize"), int):
+        data["sqlQueueSize"] = 1024
+    if not isinstance(data.get("sqlTimeout"), (int, float)):
+        data["sqlTimeout"] = 30
+    if not isinstance(data.get("sqlStatementCache"), int):
+        data["sqlStatementCache"] = 512
+    if data.get("sqlOverloadPolicy") not in [policy.value for policy in OverloadPolicy]:
+        data["sqlOverloadPolicy"] = OverloadPolicy.BLOCK.value
+    if not isinstance(data.get("screenCacheSize"), int):
+        data["screenCacheSize"] = 32 * 1024 * 1024
+    if data.get("screenCache") is None:
+        data["screenCache"] = "screens.sqlite"
+    if data.get("voteJournal") is None:
+        data["voteJournal"] = "votes.journal"
+    if data.get("archiveSnapshot") is None:
+        data["archiveSnapshot"] = "snapshots/archive"
     return data
 
 
@@ -149,5 +169,13 @@ discord_logger = logging.getLogger("discord")
 data = load_data("secrets.json")
 """Contains the configuration data."""
 
-sqlthread = SQLThread(data["db"])
-sqlthread.start()
\ No newline at end of file
+sqlthread = SQLThread(data["db"], maxsize=data["sqlQueueSize"], policy=OverloadPolicy(data["sqlOverloadPolicy"]),
+                      timeout=data["sqlTimeout"], cached_statements=data["sqlStatementCache"])
+"""Handles every SQL operation. Started by main.py, so that importing this module has no side effects on the database,
+as worker processes spawned by the bot import it too."""
+
+screencache = ScreenCache(data["screenCacheSize"], data["screenCache"])
+"""Contains the pre-rendered voting screens of the current round, and records them to survive a restart."""
+
+votebuffer = VoteBuffer(sqlthread, screencache, data["voteJournal"])
+"""Stages incoming votes before they are written to the database. Must be started once the schema exists."""
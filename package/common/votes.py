@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+from collections import namedtuple
+from glob import glob
+from threading import Thread, Event, Lock, get_ident
+from typing import Dict, List
+
+from .screens import ScreenCache
+from .sqlhandle import SQLThread, PRIORITY_HIGH
+
+sql_thread_logger = logging.getLogger("sqlitethread")
+
+StagedVote = namedtuple("StagedVote", ["vid", "gseed", "vote"])
+
+
+class InvalidVoteError(Exception):
+    pass
+
+
+def check_vote(cache: ScreenCache, vid: int, gseed: str, vote: str) -> str:
+    """Checks a vote against its screen, returning it normalized to upper case.
+    The screen must have been handed out to the voter with this VID, and a vote must rank distinct letters of it.
+    Raises InvalidVoteError otherwise."""
+    screen = cache.peek(gseed)
+    if screen is None:
+        raise InvalidVoteError("Unknown screen {}".format(gseed))
+    owner = cache.owner(gseed)
+    if owner is None:
+        raise InvalidVoteError("Screen {} has not been handed out".format(gseed))
+    if owner != vid:
+        raise InvalidVoteError("Screen {} was not given to you".format(gseed))
+    vote = vote.upper()
+    letters = [chr(ord("A") + i) for i in range(len(screen.ids))]
+    if not vote or any(c not in letters for c in vote):
+        raise InvalidVoteError("A vote on screen {} must only use the letters {}".format(gseed, "".join(letters)))
+    if len(set(vote)) != len(vote):
+        raise InvalidVoteError("A vote cannot use a letter twice")
+    return vote
+
+
+class VoteFlusher(Thread):
+    """A Timer that flushes a VoteBuffer regularly."""
+    def __init__(self, buffer, time):
+        Thread.__init__(self, daemon=True)
+        self.stopped = Event()
+        self.wake = Event()
+        self.buffer = buffer
+        self.interval = time
+
+    def run(self):
+        sql_thread_logger.debug("Vote flusher thread {}".format(get_ident()))
+        while not self.stopped.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.buffer.flush()
+
+
+class VoteBuffer:
+    """Stages accepted votes in memory and writes them to Votes in batches.
+
+    Votes are deduplicated by gseed, with the latest vote on a screen winning, and flushed in a single
+    transaction once flush_size votes are staged or every flush_interval seconds. Every accepted vote is first
+    appended to a journal, so votes acknowledged but not yet flushed are recovered after a crash.
+    Journal writes are flushed to the OS immediately and fsynced once per batch."""
+    _staged: Dict[str, StagedVote]
+    _journal_file: object
+    lock: Lock
+    flushing: Lock
+    journal: str
+    flush_size: int
+    flushed: int
+    _segment: int
+
+    def __init__(self, thread: SQLThread, cache: ScreenCache, journal: str = "votes.journal",
+                 flush_size: int = 500, flush_interval: float = 1.0):
+        self.sql = thread
+        self.cache = cache
+        self.journal = journal
+        self.flush_size = flush_size
+        self.flushed = 0
+        self._segment = 0
+        self._staged = dict()
+        self.lock = Lock()
+        self.flushing = Lock()
+        self._journal_file = None
+        self._flusher = VoteFlusher(self, flush_interval)
+
+    def start(self):
+        """Recovers votes left in journals by a previous run, then starts flushing regularly."""
+        recovered = self.recover()
+        if recovered:
+            sql_thread_logger.warning("Recovered {:d} unflushed votes from the journal".format(recovered))
+        self._journal_file = open(self.journal, "a", encoding="utf-8")
+        self._flusher.start()
+
+    def _segments(self) -> List[str]:
+        """The rotated journal segments awaiting a successful flush, oldest first."""
+        return sorted(glob(self.journal + ".*"), key=lambda p: int(p.rsplit(".", 1)[1]))
+
+    def recover(self) -> int:
+        """Stages every vote found in the journal and its rotated segments, oldest first, and flushes them."""
+        count = 0
+        segments = self._segments()
+        if segments:
+            self._segment = int(segments[-1].rsplit(".", 1)[1]) + 1
+        for path in segments + [self.journal]:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        vote = StagedVote(*json.loads(line))
+                    except (ValueError, TypeError):
+                        # a torn write from a crash can only be the last line
+                        continue
+                    self._staged[vote.gseed] = vote
+                    count += 1
+        if count:
+            self.flush()
+        return count
+
+    def __len__(self):
+        return len(self._staged)
+
+    def submit(self, vid: int, gseed: str, vote: str) -> str:
+        """Checks and stages a vote, returning the normalized vote. Raises InvalidVoteError if it is invalid.
+        Once this returns, the vote is journaled and will reach the database."""
+        vote = check_vote(self.cache, vid, gseed, vote)
+        staged = StagedVote(vid, gseed, vote)
+        with self.lock:
+            self._journal_file.write(json.dumps(staged) + "\n")
+            self._journal_file.flush()
+            self._staged[gseed] = staged
+            full = len(self._staged) >= self.flush_size
+        if full:
+            self._flusher.wake.set()
+        return vote
+
+    def flush(self) -> int:
+        """Writes all staged votes to the database in one transaction. Returns the number of votes written."""
+        with self.flushing:
+            with self.lock:
+                if not self._staged:
+                    return 0
+                batch = self._staged
+                self._staged = dict()
+                segment = None
+                if self._journal_file is not None:
+                    # rotate the journal, so that it only holds votes staged after this batch
+                    self._journal_file.flush()
+                    os.fsync(self._journal_file.fileno())
+                    self._journal_file.close()
+                    segment = "{}.{:d}".format(self.journal, self._segment)
+                    self._segment += 1
+                    os.replace(self.journal, segment)
+                    self._journal_file = open(self.journal, "a", encoding="utf-8")
+            res = self._write(list(batch.values()))
+            if isinstance(res, Exception):
+                sql_thread_logger.error("Failed to flush {:d} votes: {}".format(len(batch), res))
+                with self.lock:
+                    # keep votes staged since, as they are newer
+                    batch.update(self._staged)
+                    self._staged = batch
+                return 0
+            # every vote journaled before this flush is now in the database
+            for path in self._segments():
+                os.remove(path)
+            if segment is None and os.path.exists(self.journal):
+                os.remove(self.journal)
+            self.flushed += 1
+            sql_thread_logger.debug("Flushed {:d} votes".format(len(batch)))
+            return len(batch)
+
+    def _write(self, votes: List[StagedVote]):
+        try:
+            return self.sql.execute([
+                ("""INSERT INTO Votes (vid, vnum, gseed, vote)
+                    VALUES (?, (SELECT count(*) + 1 FROM Votes WHERE vid = ?), ?, ?)
+                    ON CONFLICT (gseed) DO UPDATE SET vote = excluded.vote WHERE vid = excluded.vid;""",
+                 (vote.vid, vote.vid, vote.gseed, vote.vote)) for vote in votes
+            ], PRIORITY_HIGH)
+        except Exception as e:
+            return e
+
+    def close(self):
+        """Stops the regular flushes and flushes what is left."""
+        self._flusher.stopped.set()
+        self._flusher.wake.set()
+        if self._flusher.is_alive():
+            self._flusher.join()
+        self.flush()
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
@@ -1,12 +1,32 @@
+import asyncio
 import logging
+import os
+from secrets import token_hex
+from threading import get_ident
+from time import strftime
 
+import discord
 from discord.ext import commands
 
+from ..common.profiling import CommandTimer, ProfileSession
+from ..common.sqlhandle import SQLThread
+from ..common.utils import sqlthread, UPLOAD_LIMIT
+
 discord_logger = logging.getLogger('discord')
 
 
 class Administrator(commands.Cog):
     """Cog that provides generic administrator commands to the owner."""
+    def __init__(self, bot: commands.Bot, sql: SQLThread, timer: CommandTimer):
+        commands.Cog.__init__(self)
+        self.bot = bot
+        self.sql = sql
+        self.timer = timer
+        self.session = None
+        self._stop_profile = asyncio.Event()
+
+    def cog_unload(self):
+        self._stop_profile.set()
 
     @commands.command(brief="Reloads a module.")
     @commands.is_owner()
@@ -50,12 +70,56 @@ class Administrator(commands.Cog):
             await ctx.send("Failed to load extension {0:s}: {0:s} errored in its entry function.".format(module))
             discord_logger.error(str(e.original))
 
+    @commands.command(brief="Profiles the bot for a while.", help="Takes the mode, sample or cprofile, and the "
+                      + "number of seconds to profile for. Writes collapsed stacks of the event loop and the SQL "
+                      + "thread, for flamegraphs, and reports the time taken by each command.")
+    @commands.is_owner()
+    async def profile(self, ctx: commands.Context, mode: str = "sample", seconds: float = 30):
+        if self.session is not None:
+            await ctx.send("Already profiling. Use profile_stop to stop early.")
+            return
+        if mode not in ProfileSession.MODES:
+            await ctx.send("Unknown mode {}. Expected one of {}.".format(mode, ", ".join(ProfileSession.MODES)))
+            return
+        discord_logger.info("{:s} started profiling in {} mode".format(str(ctx.message.author), mode))
+        self.session = session = ProfileSession(mode, get_ident(), self.sql, self.timer)
+        self._stop_profile.clear()
+        session.start()
+        await ctx.send("Profiling for {:g} seconds in {} mode.".format(seconds, mode))
+        try:
+            await asyncio.wait_for(self._stop_profile.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            session.stop()
+            self.session = None
+        os.makedirs("profiles", exist_ok=True)
+        filename = "profiles/profile" + strftime("%Y-%m-%d-%H-%M-%S") + "-" + token_hex(16)
+        filename = await self.bot.loop.run_in_executor(None, session.write, filename)
+        summary = "\n".join(session.summary())
+        if os.path.getsize(filename) <= UPLOAD_LIMIT:
+            await ctx.send(summary[:1900], file=discord.File(filename))
+        else:
+            await ctx.send(summary[:1900] + "\nSaved to filename: {}".format(filename))
+
+    @commands.command(brief="Stops profiling early.")
+    @commands.is_owner()
+    async def profile_stop(self, ctx: commands.Context):
+        if self.session is None:
+            await ctx.send("Not profiling.")
+            return
+        self._stop_profile.set()
+
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Administrator())
+    timer = CommandTimer()
+    bot.before_invoke(timer.before)
+    bot.after_invoke(timer.after)
+    bot.add_cog(Administrator(bot, sqlthread, timer))
     discord_logger.info("Loaded extension discord.admin")
 
 
 def teardown(bot: commands.Bot):
+    # the timing hooks stay installed, and do nothing while no profile is running
     bot.remove_cog("Administrator")
-    discord_logger.info("Unloaded extension discord.admin")
\ No newline at end of file
+    discord_logger.info("Unloaded extension discord.admin")
@@ -0,0 +1,153 @@
+from logging import getLogger
+
+from discord.ext import commands
+
+from ..common.bootstrap import round_intervals, RESAMPLES
+from ..common.correlation import round_clusters, MIN_OVERLAP
+from ..common.sqlhandle import SQLThread
+from ..common.snapshot import refresh_snapshot
+from ..common.sqlutils import find_duplicates, index_responses, search_archive
+from ..common.utils import sqlthread, data
+
+discord_logger = getLogger('discord')
+
+DUPLICATES_SHOWN = 10
+"""Number of likely duplicates listed by the duplicates command."""
+SEARCH_PAGE_SIZE = 10
+"""Number of matches per page of the search command."""
+CLUSTERS_SHOWN = 10
+"""Number of clusters of voters listed by the correlated command."""
+
+
+def _truncate(text: str, length: int = 80) -> str:
+    return text if len(text) <= length else text[:length - 3] + "..."
+
+
+class Responses(commands.Cog):
+    """A Cog that provides tools to search and inspect responses."""
+    def __init__(self, bot: commands.Bot, sql: SQLThread, snapshot: str):
+        commands.Cog.__init__(self)
+        self.sql = sql
+        self.bot = bot
+        self.snapshot = snapshot
+
+    @commands.command(brief="Indexes responses missing from the duplicate index.",
+                      help="Only needed once for responses added before the index existed.")
+    @commands.is_owner()
+    async def reindex(self, ctx: commands.Context):
+        await ctx.send("Indexing responses...")
+        count = await self.bot.loop.run_in_executor(None, index_responses, self.sql)
+        await ctx.send("Indexed {:d} responses.".format(count))
+
+    @commands.command(brief="Lists likely duplicate responses in this round.",
+                      help="Optionally takes the minimum similarity, between 0 and 1. Defaults to 0.6.")
+    @commands.is_owner()
+    async def duplicates(self, ctx: commands.Context, threshold: float = 0.6):
+        found = await self.bot.loop.run_in_executor(None, find_duplicates, self.sql, threshold)
+        if not found:
+            await ctx.send("No likely duplicates found.")
+            return
+        lines = ["Found {:d} likely duplicates:".format(len(found))]
+        for dup in found[:DUPLICATES_SHOWN]:
+            lines.append("{:.0%}: #{} by <@{}> ``{}`` and #{} by <@{}> ({}) ``{}``".format(
+                dup.similarity, dup.id, dup.uid, _truncate(dup.response), dup.other_id, dup.other_uid,
+                "this round" if dup.other_round is None else "round {}".format(dup.other_round),
+                _truncate(dup.other_response)))
+        await ctx.send("\n".join(lines))
+
+    @commands.command(brief="Searches archived responses.", help="Takes the words to search for. Add round:N to only "
+                      + "search round N, user:@someone or mine to only search someone's responses, and page:N to "
+                      + "see more results.")
+    async def search(self, ctx: commands.Context, *terms: str):
+        words = []
+        filters = {"uid": None, "round_num": None, "page": 1}
+        try:
+            for term in terms:
+                key, _, value = term.partition(":")
+                if term == "mine":
+                    filters["uid"] = ctx.author.id
+                elif key == "round" and value:
+                    filters["round_num"] = int(value)
+                elif key == "page" and value:
+                    filters["page"] = max(int(value), 1)
+                elif key == "user" and value:
+                    filters["uid"] = int(value.strip("<@!>"))
+                else:
+                    words.append(term)
+        except ValueError:
+            await ctx.send("Invalid filter {}.".format(term), delete_after=5)
+            return
+        if not words:
+            await ctx.send("Nothing to search for.", delete_after=5)
+            return
+        results = list(search_archive(self.sql, " ".join(words), per_page=SEARCH_PAGE_SIZE, **filters))
+        if not results:
+            await ctx.send("No matching responses found.")
+            return
+        lines = ["Page {:d} of matches for ``{}``:".format(filters["page"], " ".join(words))]
+        for res in results:
+            lines.append("Round {}, by <@{}>, rank {}: ``{}``".format(res.round_num, res.uid, res.rank,
+                                                                       _truncate(res.response, 150)))
+        await ctx.send("\n".join(lines))
+
+    @commands.command(brief="Refreshes the archive snapshot.", help="Appends rounds archived since the last refresh "
+                      + "to the memory-mapped snapshot of the archive used for analysis. Run after archiving a round.")
+    @commands.is_owner()
+    async def snapshot(self, ctx: commands.Context):
+        count = await self.bot.loop.run_in_executor(None, refresh_snapshot, self.sql, self.snapshot)
+        await ctx.send("Wrote {:d} archived responses to the snapshot.".format(count))
+
+    @commands.command(brief="Finds confidence intervals for this round's ranking.",
+                      help="Optionally takes the number of resamples, and the fraction of responses eliminated. "
+                      + "Lists responses whose contestant is not certain to survive or be eliminated.")
+    @commands.is_owner()
+    async def confidence(self, ctx: commands.Context, resamples: int = RESAMPLES, eliminate: float = 0.2):
+        await ctx.send("Bootstrapping {:d} resamples...".format(resamples))
+        intervals = await self.bot.loop.run_in_executor(None, round_intervals, self.sql, resamples, eliminate)
+        if not intervals:
+            await ctx.send("There are no votes to analyze.")
+            return
+        uncertain = [i for i in intervals if 0 < i.survival < 1]
+        lines = ["{:d} of {:d} responses have an uncertain outcome.".format(len(uncertain), len(intervals)), "```"]
+        for i in uncertain:
+            line = "#{:<4d} ({:d}-{:d}) {:.1%} [{:.1%}, {:.1%}] survives {:.1%} id {:d} uid {:d}".format(
+                i.rank, i.rank_low, i.rank_high, i.score, i.score_low, i.score_high, i.survival, i.id, i.uid)
+            if sum(len(l) + 1 for l in lines) + len(line) > 1900:
+                lines.append("...")
+                break
+            lines.append(line)
+        lines.append("```")
+        await ctx.send("\n".join(lines))
+
+    @commands.command(brief="Finds voters who vote suspiciously alike this round.",
+                      help="Optionally takes the threshold, in standard deviations, that agreement between two voters "
+                      + "must exceed, and the fewest responses both must have scored. Lists clusters of voters "
+                      + "linked by such agreement, which may be alt accounts or a brigade.")
+    @commands.is_owner()
+    async def correlated(self, ctx: commands.Context, threshold: float = None, min_overlap: int = MIN_OVERLAP):
+        await ctx.send("Correlating voters...")
+        found = await self.bot.loop.run_in_executor(None, round_clusters, self.sql, threshold, min_overlap)
+        if not found:
+            await ctx.send("No suspiciously similar voters found.")
+            return
+        lines = ["Found {:d} clusters of suspiciously similar voters:".format(len(found))]
+        for cluster in found[:CLUSTERS_SHOWN]:
+            line = "{:d} voters, {:d} flagged pairs, {:.0%} similar over {:.1f} responses: {}".format(
+                len(cluster.vids), cluster.pairs, cluster.similarity, cluster.overlap,
+                ", ".join("<@{}>".format(uid) if uid is not None else "VID {}".format(vid)
+                          for vid, uid in zip(cluster.vids, cluster.uids)))
+            if sum(len(l) + 1 for l in lines) + len(line) > 1900:
+                lines.append("...")
+                break
+            lines.append(line)
+        await ctx.send("\n".join(lines))
+
+
+def setup(bot: commands.Bot):
+    bot.add_cog(Responses(bot, sqlthread, data["archiveSnapshot"]))
+    discord_logger.info("Loaded extension discord.responses")
+
+
+def teardown(bot: commands.Bot):
+    bot.remove_cog("Responses")
+    discord_logger.info("Unloaded extension discord.responses")
@@ -1,3 +1,4 @@
+import os
 from logging import getLogger
 from secrets import token_hex
 from time import strftime, gmtime
@@ -6,9 +7,10 @@ import sqlite3
 import discord
 from discord.ext import commands
 
+from ..common.export import export_table, InvalidExportError, EXPORT_TABLES
 from ..common.sqlhandle import SQLThread
 from ..common.sqlutils import *
-from ..common.utils import sqlthread, name_string, parse_time, format_time, format_dhms
+from ..common.utils import sqlthread, name_string, parse_time, format_time, format_dhms, UPLOAD_LIMIT
 
 discord_logger = getLogger('discord')
 
@@ -48,6 +50,26 @@ class Database(commands.Cog):
             raise res
         await ctx.send("Finished snapshotting schema without issue.")
 
+    @commands.command(brief="Exports a table to a CSV or JSON Lines file.",
+                      help="Takes the table ({}), then optionally the format (csv or jsonl), ".format(
+                          ", ".join(EXPORT_TABLES)) + "whether to gzip, and a round number to export from the archive.")
+    @commands.is_owner()
+    async def export(self, ctx: commands.Context, table: str, fmt: str = "csv", compress: bool = False,
+                     round_num: int = None):
+        os.makedirs("exports", exist_ok=True)
+        filename = "exports/" + table + strftime("%Y-%m-%d-%H-%M-%S") + "-" + token_hex(16)
+        await ctx.send("Exporting {}...".format(table))
+        try:
+            filename, count = await self.bot.loop.run_in_executor(
+                None, export_table, self.sql.db, table, filename, fmt, compress, round_num)
+        except InvalidExportError as e:
+            await ctx.send(str(e))
+            return
+        if os.path.getsize(filename) <= UPLOAD_LIMIT:
+            await ctx.send("Exported {:d} rows.".format(count), file=discord.File(filename))
+        else:
+            await ctx.send("Exported {:d} rows to filename: {}".format(count, filename))
+
     @commands.command(brief="Make a SQL request and get a result (if any).", help="Greedily takes string for request."
                       + "Quote the query string and put it last. Any params should go first.")
     @commands.is_owner()
@@ -68,6 +90,23 @@ class Database(commands.Cog):
             return
         await ctx.send("Result: ``" + str(res) + "``")
 
+    @commands.command(brief="Get the running time of each named query.", help="Optionally takes whether to reset "
+                      + "the timings afterwards.")
+    @commands.is_owner()
+    async def query_times(self, ctx: commands.Context, reset: bool = False):
+        timings = self.sql.query_timings(reset)
+        if not timings:
+            await ctx.send("No named queries have run yet.")
+            return
+        embed = discord.Embed(color=0x3daeff)
+        embed.title = "Query Timings"
+        embed.set_author(name=self.bot.user.name) \
+            .set_footer(text=name_string(self.bot.get_user(self.bot.owner_id)))
+        for timing in timings[:25]:
+            embed.add_field(name=timing.name, value="{:d} runs, {:.1f}ms total, {:.2f}ms mean, {:.2f}ms max".format(
+                timing.count, timing.total * 1000, timing.total / timing.count * 1000, timing.max * 1000))
+        await ctx.send(embed=embed)
+
     @commands.command(brief="Get the current status.")
     async def status(self, ctx: commands.Context):
         status = list(get_status(self.sql))[0]
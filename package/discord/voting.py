@@ -0,0 +1,119 @@
+from logging import getLogger
+
+import discord
+from discord.ext import commands
+
+from ..common.screens import ScreenCache, prerender, next_screen
+from ..common.sqlhandle import SQLThread
+from ..common.sqlutils import get_status, get_vids, set_phase, uid2vid
+from ..common.utils import sqlthread, screencache, votebuffer, name_string
+from ..common.votes import VoteBuffer, InvalidVoteError
+
+discord_logger = getLogger('discord')
+
+SCREENS_PER_VOTER = 3
+"""Number of screens pre-rendered for each voter when voting opens."""
+
+
+class Voting(commands.Cog):
+    """A Cog that handles the phases of a round, hands out voting screens and takes votes."""
+    def __init__(self, bot: commands.Bot, sql: SQLThread, cache: ScreenCache, votes: VoteBuffer):
+        commands.Cog.__init__(self)
+        self.sql = sql
+        self.bot = bot
+        self.cache = cache
+        self.votes = votes
+        self.vids = dict()
+        """VIDs of voters by UID, so that voting does not wait on the database."""
+        self.voting = None
+        """Whether the round is in its voting phase, or None until read from Status."""
+
+    @commands.command(brief="Sets the phase of the round.", help="Takes the phase name. When switching to voting, "
+                      + "optionally takes the number of screens to pre-render.")
+    @commands.is_owner()
+    async def phase(self, ctx: commands.Context, phase: str, screens: int = None):
+        set_phase(self.sql, phase)
+        self.voting = False
+        self.vids.clear()
+        if phase != "voting":
+            self.cache.clear()
+            await ctx.send("Set phase to {}.".format(phase))
+            return
+        if screens is None:
+            screens = max(len(get_vids(self.sql)), 1) * SCREENS_PER_VOTER
+        prompt = list(get_status(self.sql))[0].prompt
+        await ctx.send("Set phase to voting. Pre-rendering {:d} screens...".format(screens))
+        count = await self.bot.loop.run_in_executor(None, prerender, self.sql, self.cache, screens, prompt)
+        self.voting = True
+        await ctx.send("Pre-rendered {:d} screens.".format(count))
+
+    def _is_voting(self) -> bool:
+        if self.voting is None:
+            self.voting = list(get_status(self.sql))[0].phase == "voting"
+        return self.voting
+
+    def _vid(self, uid: int):
+        """The VID of a voter, or None if they are not registered."""
+        vid = self.vids.get(uid)
+        if vid is None:
+            try:
+                vid = uid2vid(self.sql, uid)
+            except IndexError:
+                vid = None
+            if vid is not None:
+                self.vids[uid] = vid
+        return vid
+
+    @commands.command(brief="Get a voting screen.")
+    async def screen(self, ctx: commands.Context):
+        if not self._is_voting():
+            await ctx.send("Voting is not open.", delete_after=5)
+            return
+        vid = self._vid(ctx.author.id)
+        if vid is None:
+            await ctx.send("You are not registered as a voter.", delete_after=5)
+            return
+        screen = next_screen(self.sql, self.cache, vid)
+        if screen is None:
+            await ctx.send("There are no responses to vote on.", delete_after=5)
+            return
+        await ctx.author.send(screen.text)
+
+    @commands.command(brief="Vote on a screen.", help="Takes the screen's seed, then its letters from best to worst.")
+    async def vote(self, ctx: commands.Context, gseed: str, vote: str):
+        vid = self._vid(ctx.author.id)
+        if vid is None:
+            await ctx.send("You are not registered as a voter.", delete_after=5)
+            return
+        try:
+            vote = self.votes.submit(vid, gseed, vote)
+        except InvalidVoteError as e:
+            await ctx.send(str(e), delete_after=5)
+            return
+        await ctx.send("Recorded your vote {} on screen {}.".format(vote, gseed))
+
+    @commands.command(brief="Get voting screen cache statistics.")
+    @commands.is_owner()
+    async def screen_stats(self, ctx: commands.Context):
+        stats = self.cache.stats()
+        embed = discord.Embed(color=0x3daeff)
+        embed.title = "Voting Screen Cache"
+        embed.set_author(name=self.bot.user.name) \
+            .add_field(name="Screens", value="{screens:d} ({unassigned:d} not handed out)".format(**stats)) \
+            .add_field(name="In Memory", value="{in_memory:d} screens, {memory_used:d} of {memory_limit:d} bytes"
+                       .format(**stats)) \
+            .add_field(name="Spilled to SQLite", value=str(stats["spilled"])) \
+            .add_field(name="Hit Rate", value="{:.1%} ({:d} hits, {:d} misses)"
+                       .format(stats["hit_rate"], stats["hits"], stats["misses"])) \
+            .set_footer(text=name_string(self.bot.get_user(self.bot.owner_id)))
+        await ctx.send(embed=embed)
+
+
+def setup(bot: commands.Bot):
+    bot.add_cog(Voting(bot, sqlthread, screencache, votebuffer))
+    discord_logger.info("Loaded extension discord.voting")
+
+
+def teardown(bot: commands.Bot):
+    bot.remove_cog("Voting")
+    discord_logger.info("Unloaded extension discord.voting")